@@ -0,0 +1,210 @@
+"""
+acme.sh beacon
+
+Fires an event as soon as a certificate of acme.sh is due for renewal.
+
+The renewal times are kept in memory, a domain conf is only read again
+after its mtime changed. The cert_path is only listed again after the
+mtime of the directory changed.
+
+.. code-block:: yaml
+
+    beacons:
+      acme_sh:
+        - user: root
+        - cert_path: /etc/acme
+        - renew_window: 168
+        - interval: 300
+"""
+
+import os
+import time
+import logging
+
+import salt.utils.beacons
+
+log = logging.getLogger(__name__)
+
+__virtualname__ = "acme_sh"
+
+if "__context__" not in globals():
+    __context__ = {}
+
+if "__salt__" not in globals():
+    __salt__ = {}
+
+
+def __virtual__():
+    """
+    Only load if the acme_sh module is available in __salt__
+    """
+    if "acme_sh.info" in __salt__:
+        return __virtualname__
+    return False, "acme_sh module could not be loaded"
+
+
+def validate(config):
+    """
+    Validate the beacon configuration
+    """
+
+    if not isinstance(config, list):
+        return False, "Configuration for acme_sh beacon must be a list"
+
+    config = salt.utils.beacons.list_to_dict(config)
+
+    if "user" in config and not isinstance(config["user"], str):
+        return False, "user for acme_sh beacon must be a string"
+
+    if "cert_path" in config and not isinstance(config["cert_path"], str):
+        return False, "cert_path for acme_sh beacon must be a string"
+
+    if "renew_window" in config and not isinstance(
+        config["renew_window"], (int, float)
+    ):
+        return False, "renew_window for acme_sh beacon must be a number"
+
+    return True, "Valid beacon configuration"
+
+
+def _mtime(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+
+def _domain(dir_name):
+    # acme.sh stores ecc certificates in <name>_ecc
+    return dir_name[: -len("_ecc")] if dir_name.endswith("_ecc") else dir_name
+
+
+def _conf_mtime(path, name):
+    """
+    Newest mtime of the domain confs of name, rsa and ecc
+    """
+
+    mtimes = [
+        mtime
+        for mtime in (
+            _mtime(f"{path}/{dir_name}/{name}.conf")
+            for dir_name in (name, f"{name}_ecc")
+        )
+        if mtime is not None
+    ]
+    return max(mtimes) if mtimes else None
+
+
+def _scan(cert_path):
+    """
+    Return all domains with a domain conf in cert_path
+    """
+
+    try:
+        entries = list(os.scandir(cert_path))
+    except OSError as err:
+        log.debug("Unable to scan %s: %s", cert_path, err)
+        return set()
+
+    return {
+        _domain(entry.name)
+        for entry in entries
+        if entry.is_dir() and os.path.isfile(f"{entry.path}/{_domain(entry.name)}.conf")
+    }
+
+
+def _table(user, cert_path):
+    if "acme_sh.beacon" not in __context__:
+        __context__["acme_sh.beacon"] = {}
+
+    key = (user, cert_path)
+    if key not in __context__["acme_sh.beacon"]:
+        if not cert_path:
+            home_dir = __salt__["user.info"](user)["home"]
+            path = f"{home_dir}/.acme.sh"
+        else:
+            path = cert_path
+        __context__["acme_sh.beacon"][key] = {
+            "path": path,
+            "dir_mtime": None,
+            "domains": {},
+        }
+
+    return __context__["acme_sh.beacon"][key]
+
+
+def _next_renew(name, user, cert_path, renew_window=0):
+    crt_info = __salt__["acme_sh.info"](name, user=user, cert_path=cert_path)
+
+    try:
+        next_renew = int(crt_info["Le_NextRenewTime"])
+    except (TypeError, KeyError, ValueError):
+        return None
+
+    if renew_window:
+        next_renew += __salt__["acme_sh.renew_offset"](name, renew_window)
+    return next_renew
+
+
+def beacon(config):
+    """
+    Fire an event for every certificate which became due for renewal
+
+    .. code-block:: yaml
+
+        beacons:
+          acme_sh:
+            - user: root
+            - cert_path: /etc/acme
+            - renew_window: 168
+
+    With renew_window, the event of a domain is delayed by the same
+    stable offset as in the acme_sh.cert state.
+
+    The event tag is ``salt/beacon/<minion_id>/acme_sh/<domain>``,
+    the data contains domain, user, cert_path and next_renew_time.
+    """
+
+    config = salt.utils.beacons.list_to_dict(config)
+    user = config.get("user", "root")
+    cert_path = config.get("cert_path")
+    renew_window = config.get("renew_window", 0)
+
+    table = _table(user, cert_path)
+    domains = table["domains"]
+
+    # only list the directory again if a domain was added or removed
+    dir_mtime = _mtime(table["path"])
+    if dir_mtime != table["dir_mtime"]:
+        table["dir_mtime"] = dir_mtime
+        found = _scan(table["path"])
+        for name in set(domains) - found:
+            del domains[name]
+        for name in found - set(domains):
+            domains[name] = {"mtime": None, "next_renew": None, "fired": False}
+
+    now = int(time.time())
+    ret = []
+    for name, entry in domains.items():
+        conf_mtime = _conf_mtime(table["path"], name)
+        if conf_mtime != entry["mtime"]:
+            entry["mtime"] = conf_mtime
+            entry["next_renew"] = _next_renew(name, user, cert_path, renew_window)
+            entry["fired"] = False
+
+        if entry["fired"] or entry["next_renew"] is None:
+            continue
+
+        if now > entry["next_renew"]:
+            entry["fired"] = True
+            ret.append(
+                {
+                    "tag": name,
+                    "domain": name,
+                    "user": user,
+                    "cert_path": table["path"],
+                    "next_renew_time": entry["next_renew"],
+                }
+            )
+
+    return ret
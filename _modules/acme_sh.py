@@ -5,8 +5,30 @@ This module interacts with acme.sh https://github.com/acmesh-official/acme.sh
 """
 
 import os
+import asyncio
+import base64
+import binascii
+import contextlib
+import datetime
+import errno
+import fcntl
+import grp
+import hashlib
+import json
 import logging
+import pwd
+import random
 import re
+import shutil
+import socket
+import sqlite3
+import subprocess
+import tarfile
+import tempfile
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 import salt.utils.path
 from salt.exceptions import (
@@ -15,8 +37,230 @@ from salt.exceptions import (
     CommandNotFoundError,
 )
 
+try:
+    from cryptography import x509
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.asymmetric import ec, padding, rsa
+    from cryptography.hazmat.primitives.asymmetric.utils import (
+        decode_dss_signature,
+    )
+    from cryptography.x509.oid import NameOID
+
+    HAS_CRYPTOGRAPHY = True
+except ImportError:
+    HAS_CRYPTOGRAPHY = False
+
+try:
+    import requests
+    from requests.adapters import HTTPAdapter
+
+    HAS_REQUESTS = True
+except ImportError:
+    HAS_REQUESTS = False
+
 log = logging.getLogger(__name__)
 
+# acme.sh stores values with special characters base64 encoded between these markers
+_B64CONF_START = "__ACME_BASE64__START_"
+_B64CONF_END = "__ACME_BASE64__END_"
+
+# acme.sh log lines start with a timestamp and may contain color codes
+_LOG_PREFIX = re.compile(r"^\[[^\]]*\]\s*")
+_ANSI_COLOR = re.compile(r"\x1b\[[0-9;]*m")
+_RENEW_ALL_DOMAIN = re.compile(r"^(?:Renew|Renewing):\s*'([^']+)'")
+
+_ACME_SH_SOURCE = "https://github.com/acmesh-official/acme.sh"
+_SOURCE_MANIFEST = ".salt-acme-sh.sha256"
+_ARCHIVE_SUFFIXES = (".tar", ".tar.gz", ".tgz", ".tar.bz2", ".tar.xz")
+
+# running http-01 challenge responders per port
+_RESPONDERS = {}
+_RESPONDERS_LOCK = threading.Lock()
+_CHALLENGE_PATH = re.compile(r"^/\.well-known/acme-challenge/([A-Za-z0-9_-]+)$")
+
+# directories of the acme.sh server short names
+_ACME_SERVERS = {
+    "letsencrypt": "https://acme-v02.api.letsencrypt.org/directory",
+    "letsencrypt_test": "https://acme-staging-v02.api.letsencrypt.org/directory",
+    "zerossl": "https://acme.zerossl.com/v2/DV90",
+    "buypass": "https://api.buypass.com/acme/directory",
+    "buypass_test": "https://api.test4.buypass.no/acme/directory",
+    "sslcom": "https://acme.ssl.com/sslcom-dv-rsa",
+    "google": "https://dv.acme-v02.api.pki.goog/directory",
+    "googletest": "https://dv.acme-v02.test-api.pki.goog/directory",
+}
+
+# if acme.sh or the python client started the current order of the thread,
+# the ledger releases the reservation of orders which never started
+_ORDER_STATE = threading.local()
+
+# python backend clients per directory, account key and ssl verification
+_ACME_CLIENTS = {}
+_ACME_CLIENTS_LOCK = threading.Lock()
+
+
+# sqlite databases in <cachedir>/acme_sh, created on first use
+_DB_SCHEMAS = {
+    "ledger": """
+        CREATE TABLE IF NOT EXISTS ledger (
+            server TEXT NOT NULL,
+            account TEXT NOT NULL,
+            kind TEXT NOT NULL,
+            scope TEXT NOT NULL,
+            hour INTEGER NOT NULL,
+            count INTEGER NOT NULL,
+            PRIMARY KEY (server, account, kind, scope, hour)
+        ) WITHOUT ROWID;
+    """,
+    "inventory": """
+        CREATE TABLE IF NOT EXISTS certs (
+            path TEXT PRIMARY KEY,
+            name TEXT NOT NULL,
+            user TEXT NOT NULL,
+            cert_path TEXT NOT NULL,
+            keylength TEXT,
+            not_after INTEGER,
+            next_renew INTEGER,
+            conf_mtime INTEGER
+        );
+        CREATE INDEX IF NOT EXISTS certs_cert_path ON certs (cert_path);
+        CREATE TABLE IF NOT EXISTS names (
+            name TEXT NOT NULL,
+            path TEXT NOT NULL,
+            PRIMARY KEY (name, path)
+        ) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS names_path ON names (path);
+        CREATE TABLE IF NOT EXISTS details (
+            path TEXT PRIMARY KEY,
+            issuer TEXT,
+            key_type TEXT
+        );
+    """,
+}
+
+# rate limits of the ledger: maximum count per window of hours,
+# defaults of Let's Encrypt, see https://letsencrypt.org/docs/rate-limits/
+_RATE_LIMITS = {
+    "orders": {"limit": 300, "hours": 3},
+    "domain": {"limit": 50, "hours": 168},
+    "duplicate": {"limit": 5, "hours": 168},
+    "failures": {"limit": 5, "hours": 1},
+}
+# public suffixes with more than one label, a registered domain is one label
+# longer; extended by acme_sh_ratelimits:public_suffixes
+_PUBLIC_SUFFIXES = frozenset(
+    f"{second}.{tld}"
+    for tld, seconds in {
+        "uk": ("co", "org", "me", "ltd", "plc", "net", "ac", "gov", "sch"),
+        "au": ("com", "net", "org", "edu", "gov", "asn", "id"),
+        "nz": ("co", "net", "org", "ac", "govt", "geek", "school"),
+        "jp": ("co", "ne", "or", "ac", "ad", "ed", "go", "gr", "lg"),
+        "za": ("co", "org", "net", "web", "gov", "ac"),
+        "br": ("com", "net", "org", "gov", "edu"),
+        "in": ("co", "net", "org", "firm", "gen", "ind", "ac", "edu", "gov"),
+        "kr": ("co", "ne", "or", "re", "ac", "go"),
+        "cn": ("com", "net", "org", "gov", "edu", "ac"),
+        "tr": ("com", "net", "org", "gen", "biz", "info", "gov", "edu"),
+        "il": ("co", "org", "net", "ac", "gov", "muni"),
+        "mx": ("com", "net", "org", "gob", "edu"),
+        "ar": ("com", "net", "org", "gob", "edu"),
+        "sg": ("com", "net", "org", "gov", "edu"),
+        "hk": ("com", "net", "org", "gov", "edu", "idv"),
+        "tw": ("com", "net", "org", "gov", "edu", "idv"),
+    }.items()
+    for second in seconds
+)
+_LEDGER_SKIPPED = (
+    "re run with `force=True`",
+    "add force=True to renew",
+    "is not an issued domain",
+    "Please register your account",
+)
+
+# failure classes of acme.sh outputs, the first match wins
+_FAILURE_CLASSES = (
+    ("skipped", re.compile(r"Next renewal time is|is not an issued domain|Skip,")),
+    ("rate_limit", re.compile(r"rateLimited|too many (certificates|requests)", re.I)),
+    ("account", re.compile(r"register-account|accountDoesNotExist|Please update")),
+    (
+        "dns",
+        re.compile(
+            r"Error add txt|Can not find dns api|dns_\w+: (error|Error)|invalid domain",
+            re.I,
+        ),
+    ),
+    (
+        "network",
+        re.compile(
+            r"Could not (get nonce|resolve)|Can not init api|timed out|"
+            r"Connection refused|Please refer to https://curl|badNonce|"
+            r"serverInternal|Service Unavailable|Bad Gateway",
+            re.I,
+        ),
+    ),
+    (
+        "validation",
+        re.compile(r"Verify error|Invalid status|error:unauthorized|error:dns", re.I),
+    ),
+)
+
+# phases of an issue, a line of acme.sh starts the phase of the first match
+_TRACE_PHASES = (
+    (
+        "account",
+        re.compile(r"Using CA:|account key|Registering account|Already registered"),
+    ),
+    (
+        "new-order",
+        re.compile(r"Creating domain key|(Single|Multi) domain=|Getting domain auth"),
+    ),
+    ("authorization", re.compile(r"Getting webroot|authz|Already verified")),
+    (
+        "challenge publish",
+        re.compile(r"Adding (txt|TXT)|txt record is added|Standalone mode server"),
+    ),
+    (
+        "propagation wait",
+        re.compile(
+            r"check each DNS record|Sleep \d+ seconds|Checking .* _acme-challenge"
+        ),
+    ),
+    ("validation", re.compile(r"Verifying:|Pending|\] Success$|Verify error")),
+    ("finalize", re.compile(r"Verify finished|finalize|Order status is")),
+    ("download", re.compile(r"Downloading cert|Cert success|Your cert is in")),
+)
+
+# lines of a traced acme.sh output which are kept
+_TRACE_LINES = 200
+
+# failure classes which are retried, the others fail immediately; a failed
+# validation (wrong txt record, webroot 404, unauthorized) fails again
+_TRANSIENT_FAILURES = ("network",)
+
+# backoff of retries in seconds, doubled per attempt
+_RETRY_BASE_DELAY = 5
+_RETRY_MAX_DELAY = 60
+
+# http status codes of the ACME server which are retried
+_RETRY_STATUS = (500, 502, 503, 504)
+
+# buckets of the duration histogram in seconds
+_METRIC_BUCKETS = (1, 5, 10, 30, 60, 120, 300, 600)
+
+# acme.sh versions per script path, valid as long as the mtime is unchanged
+_VERSION_CACHE = {}
+_SCRIPT_VERSION = re.compile(r"^VER=[\"']?([^\"'\s]+)", re.MULTILINE)
+
+# files of a certificate which are distributed by the acme_sh runner, not the
+# domain conf: acme.sh on the target would renew the certificate with it
+_CERT_FILES = ("{name}.cer", "{name}.key", "fullchain.cer", "ca.cer")
+
+# parsed certificates per path, valid as long as mtime and size are unchanged
+_X509_CACHE = {}
+
+_CONF_LINE = re.compile(r"^([A-Za-z_][A-Za-z0-9_]*)=(.*)$")
+_CONF_PLAIN_VALUE = re.compile(r"^[^\s'\"`$\\;&|<>()]*$")
+
 if "__context__" not in globals():
     __context__ = {}
 
@@ -38,497 +282,4043 @@ def _get_acme_bin(home_dir):
     return script_path
 
 
-def _upgrade(home_dir, user):
-    acme_bin = _get_acme_bin(home_dir)
-    old_version = version(user)
+def _cache(section):
+    """
+    Return a section of the per run cache in __context__
+    """
 
-    cmd = [acme_bin, "--upgrade"]
+    if "acme_sh.cache" not in __context__:
+        __context__["acme_sh.cache"] = {}
+    cache = __context__["acme_sh.cache"]
 
-    upgrade = __salt__["cmd.run_all"](" ".join(cmd), python_shell=False, runas=user)
+    if section not in cache:
+        cache[section] = {"entries": {}, "hits": 0, "misses": 0}
 
-    if upgrade["retcode"] == 0:
-        new_version = version(user)
+    return cache[section]
 
-        if old_version == new_version:
-            ret = "Already up-to-date"
-        else:
-            ret = {"old": old_version, "new": new_version}
 
-    else:
-        ret = upgrade
+def _count_lookup(section, hit):
+    cache = _cache(section)
+    cache["hits" if hit else "misses"] += 1
+    log.debug(
+        "acme_sh cache %s %s: %s hits, %s misses",
+        section,
+        "hit" if hit else "miss",
+        cache["hits"],
+        cache["misses"],
+    )
 
-    return ret
 
+def _cached(section, key, func):
+    """
+    Return the cached value of key or store the result of func
+    """
 
-def _generate_crt_ret(name, cert_path):
-    return {
-        "certificate": f"{cert_path}/{name}/{name}.cer",
-        "private_key": f"{cert_path}/{name}/{name}.key",
-        "fullchain": f"{cert_path}/{name}/fullchain.cer",
-        "ca": f"{cert_path}/{name}/ca.cer",
-    }
+    entries = _cache(section)["entries"]
 
+    if key in entries:
+        _count_lookup(section, True)
+        return entries[key]
 
-def install(email, user="root", upgrade=False, force=False):
-    """
-    Install acme.sh
+    _count_lookup(section, False)
+    entries[key] = func()
+    return entries[key]
 
-    email
-      used to register an account to acme server, you will receive a renewal notice email here
 
-    user
-      user to install
-      default: root
+def _home_dir(user):
+    return _cached("home", user, lambda: __salt__["user.info"](user)["home"])
 
-    upgrade
-      upgrade acme.sh
-      default: False
 
-    force
-      force installation
-      default: False
-    """
+def _acme_bin(user):
+    return _cached("bin", user, lambda: _get_acme_bin(_home_dir(user)))
 
-    home_dir = __salt__["user.info"](user)["home"]
-    script_path = f"{home_dir}/.acme.sh/acme.sh"
 
-    # if already installed
-    if __salt__["file.file_exists"](script_path):
-        if upgrade:
-            return _upgrade(home_dir, user)
+def _default_cert_path(user, cert_path):
+    return cert_path or f"{_home_dir(user)}/.acme.sh"
 
-        if not force:
-            return "Already installed, re-run with force=True to force installation"
 
-    # clone https://github.com/acmesh-official/acme.sh
-    clone_name = f"acme.sh-{user}"
-    __salt__["git.clone"](
-        "/tmp", url="https://github.com/acmesh-official/acme.sh", name=clone_name
-    )
+def _conf_mtime(conf_path):
+    try:
+        return os.stat(conf_path).st_mtime_ns
+    except OSError:
+        return None
 
-    if __context__["retcode"] == 1:
-        raise CommandExecutionError("Failed to clone the acme.sh repository")
 
-    cmd = ["./acme.sh", "--install", "--accountemail", email, "--nocron"]
+def _dir_domain(dir_name):
+    # acme.sh stores ecc certificates in <name>_ecc
+    return dir_name[: -len("_ecc")] if dir_name.endswith("_ecc") else dir_name
 
-    install_cmd = __salt__["cmd.run_all"](
-        " ".join(cmd), cwd=f"/tmp/{clone_name}", runas=user
-    )
-    __salt__["file.remove"](f"/tmp/{clone_name}")
 
-    # check install process successfully
-    if install_cmd["retcode"] == 0:
-        log.debug("acme.sh successfully installed")
-    else:
-        __context__["retcode"] = 1
-        return "Installation failed, see logfiles for more information"
+def _domain_dir(cert_path, name, keysize=None):
+    """
+    Domain dir of name in cert_path
 
-    return f"acme.sh successfully installed in {os.path.dirname(script_path)}"
+    With keysize, the dir acme.sh uses for this key type: <name>_ecc for
+    ecc keys, <name> for rsa keys. Without keysize, the existing dir with
+    the newest domain conf.
+    """
 
+    if keysize is not None:
+        return os.path.join(
+            cert_path, name + ("_ecc" if str(keysize).startswith("ec-") else "")
+        )
 
-def register(email, user="root"):
-    """
-    Register account @ zeroSSL CA
-    This step is required if you are using zeroSSL CA
+    found = []
+    for dir_name in (name, f"{name}_ecc"):
+        mtime = _conf_mtime(os.path.join(cert_path, dir_name, f"{name}.conf"))
+        if mtime is not None:
+            found.append((mtime, dir_name))
+    return os.path.join(cert_path, max(found)[1] if found else name)
 
-    email
-      email to register
 
-    user
-      run the command as a specified user
-      default: root
+def _ecc_args(domain_dir):
+    # acme.sh picks the rsa cert of a domain without --ecc
+    return ["--ecc"] if domain_dir.endswith("_ecc") else []
+
+
+def _info_cache_get(name, user, cert_path):
     """
+    Return the cached info result or None
 
-    home_dir = __salt__["user.info"](user)["home"]
+    An entry is only valid as long as the domain conf is unchanged.
+    """
 
-    acme_bin = _get_acme_bin(home_dir)
+    cache = _cache("info")
+    key = (user, _default_cert_path(user, cert_path), name)
+    entry = cache["entries"].get(key)
 
-    cmd = [acme_bin, "--register-account", "-m", email]
+    if entry is None or entry["mtime"] != _conf_mtime(entry["conf"]):
+        _count_lookup("info", False)
+        return None
+
+    _count_lookup("info", True)
+    return entry
+
+
+def _info_cache_set(name, user, cert_path, code, ret):
+    cert_path = _default_cert_path(user, cert_path)
+    conf_path = os.path.join(_domain_dir(cert_path, name), f"{name}.conf")
+    _cache("info")["entries"][(user, cert_path, name)] = {
+        "conf": conf_path,
+        "mtime": _conf_mtime(conf_path),
+        "code": code,
+        "ret": ret,
+    }
 
-    register_cmd = __salt__["cmd.run_all"](
-        " ".join(cmd), python_shell=False, runas=user
+
+def _info_cache_invalidate(name, user, cert_path):
+    key = (user, _default_cert_path(user, cert_path), name)
+    if _cache("info")["entries"].pop(key, None) is not None:
+        log.debug("acme_sh cache info invalidated for %s", name)
+
+
+def _upgrade(user, source=None, source_hash=None, source_rev=None):
+    old_version = version(user)
+
+    # nothing to do if the cached source has the installed version
+    target_version = _script_version(
+        os.path.join(_source_cache(source, source_hash, source_rev), "acme.sh")
     )
+    if target_version and target_version == old_version:
+        return "Already up-to-date"
 
-    if register_cmd["retcode"] == 0:
-        match = re.search(r"ACCOUNT_THUMBPRINT='([^']+)'", register_cmd["stdout"])
-        if match:
-            ret = {"account_thumbprint": match.group(1)}
+    upgrade = _install_from_source(
+        user, ["--install", "--nocron"], source, source_hash, source_rev
+    )
+
+    if upgrade["retcode"] == 0:
+        new_version = version(user)
+
+        if old_version == new_version:
+            ret = "Already up-to-date"
         else:
-            __context__["retcode"] = 1
-            ret = "Account registration failed"
+            ret = {"old": old_version, "new": new_version}
+
+    else:
+        ret = upgrade
 
     return ret
 
 
-def issue(
-    name,
-    acme_mode,
-    aliases=None,
-    server="letsencrypt",
-    keysize="4096",
-    dns_plugin=None,
-    webroot=None,
-    http_port=None,
-    user="root",
-    cert_path=None,
-    dns_credentials=None,
-    force=False,
-    valid_to=None,
-    valid_from=None,
-    insecure=False,
-):
+def _script_version(script_path):
     """
-    Obtain a certificate
+    Read the VER= assignment of an acme.sh script, cached by mtime
 
-    name
-      Common name of the certificate
+    Returns None if the script does not exist or has no VER= line.
+    """
 
-    acme_mode
-      choose one acme mode (webroot, standalone, standalone-tls-alpn, dns)
+    try:
+        mtime = os.stat(script_path).st_mtime_ns
+    except OSError:
+        return None
 
-    aliases
-      comma seperated, subjectAltNames
+    cached = _VERSION_CACHE.get(script_path)
+    if cached and cached[0] == mtime:
+        return cached[1]
 
-    server
-      acme server
-      default = letsencrypt
+    try:
+        with open(script_path, encoding="utf-8", errors="replace") as script:
+            # VER= is part of the header of acme.sh
+            match = _SCRIPT_VERSION.search(script.read(8192))
+    except OSError:
+        return None
 
-    keysize
-      RSA key bits
-      default = 4096
-      possible values:
-        ec-256 (prime256v1, "ECDSA P-256", which is the default key type)
-        ec-384 (secp384r1, "ECDSA P-384")
-        ec-521 (secp521r1, "ECDSA P-521", which is not supported by Let's Encrypt yet.)
-        2048 (RSA2048)
-        3072 (RSA3072)
-        4096 (RSA4096)
+    ret = match.group(1) if match else None
+    _VERSION_CACHE[script_path] = (mtime, ret)
 
-    dns_plugin
-      dns plugin to use
-      see https://github.com/acmesh-official/acme.sh/wiki/dnsapi
+    return ret
 
-    webroot
-      if acme_mode == webroot, full path to webroot
 
-    http_port
-      the port the server listen on during standalone or standalone-tls-alpn
+def _sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as sha_file:
+        for chunk in iter(lambda: sha_file.read(65536), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
 
-    user
-      run the command as a specified user
-      default: root
 
-    cert_path
-      installation dir of certs
-      default = ~/.acme.sh
+def _check_hash(path, source_hash):
+    # accept `sha256=<hash>` and `<hash>`
+    expected = source_hash.split("=", 1)[-1].strip().lower()
+    if _sha256(path) != expected:
+        raise CommandExecutionError(f"Checksum of {path} does not match {source_hash}")
 
-    dns_credentials
-      dns crededentials as python dict
-      see https://github.com/acmesh-official/acme.sh/wiki/dnsapi
 
-    force
-      force issuing a certificate
-      default = False
+def _source_valid(path):
+    manifest = os.path.join(path, _SOURCE_MANIFEST)
+    try:
+        with open(manifest, encoding="utf-8") as manifest_file:
+            expected = manifest_file.read().strip()
+        return _sha256(os.path.join(path, "acme.sh")) == expected
+    except OSError:
+        return False
 
-    valid_to
-      NotAfter field in cert
-      see https://github.com/acmesh-official/acme.sh/wiki/Validity
 
-    valid_from
-      NotBefore field in cert
-      see https://github.com/acmesh-official/acme.sh/wiki/Validity
+def _write_manifest(path):
+    with open(os.path.join(path, _SOURCE_MANIFEST), "w", encoding="utf-8") as manifest:
+        manifest.write(_sha256(os.path.join(path, "acme.sh")))
 
-    insecure
-      disable ssl verification
-      default: False
-    """
 
-    home_dir = __salt__["user.info"](user)["home"]
+def _source_cache(source=None, source_hash=None, source_rev=None):
+    """
+    Return the path of a local acme.sh source tree shared by all users
 
-    if acme_mode == "standalone" or acme_mode == "standalone-tls-alpn":
-        # check socat is installed, when standalone
-        if not salt.utils.path.which_bin(["socat"]):
-            __context__["retcode"] = 1
-            return "Install socat to use standalone mode first"
+    A source is fetched once and verified by the checksum of acme.sh on
+    every use. Git sources without source_rev are updated once per run,
+    an update which does not match source_hash is removed again.
+    """
 
-    acme_bin = _get_acme_bin(home_dir)
+    source = source or _ACME_SH_SOURCE
+    is_archive = source.endswith(_ARCHIVE_SUFFIXES)
 
-    # check keysize
-    possible_keylength = ["ec-256", "ec-384", "ec-521", "2048", "3072", "4096"]
-    if keysize not in possible_keylength:
-        raise SaltInvocationError(f"Keysize {keysize} not supported")
+    key = hashlib.sha256(
+        f"{source}@{source_rev or ''}#{source_hash or ''}".encode()
+    ).hexdigest()[:16]
+    base = os.path.join(
+        __opts__.get("cachedir", "/var/cache/salt/minion"), "acme_sh", "src"
+    )
+    path = os.path.join(base, key)
+
+    if "acme_sh.source" not in __context__:
+        __context__["acme_sh.source"] = set()
+    fresh = __context__["acme_sh.source"]
+
+    if _source_valid(path):
+        if key in fresh or is_archive or source_rev:
+            log.debug("Use cached acme.sh source %s", path)
+            return path
+
+        # follow the branch of an unpinned git source, once per run
+        __salt__["git.pull"](path)
+        if source_hash:
+            try:
+                _check_hash(os.path.join(path, "acme.sh"), source_hash)
+            except CommandExecutionError:
+                # never keep pulled code which does not match the hash
+                shutil.rmtree(path)
+                raise
+        _write_manifest(path)
+        fresh.add(key)
+        return path
+
+    if os.path.exists(path):
+        log.warning("Cached acme.sh source %s is invalid, fetch again", path)
+        shutil.rmtree(path)
+
+    os.makedirs(base, mode=0o700, exist_ok=True)
+    tmp_dir = tempfile.mkdtemp(dir=base)
+    try:
+        if is_archive:
+            archive = source
+            if "://" in source:
+                archive = __salt__["cp.cache_file"](source)
+            if not archive or not os.path.isfile(archive):
+                raise CommandExecutionError(f"Unable to fetch {source}")
+            if source_hash:
+                _check_hash(archive, source_hash)
+
+            # the tree must not be tmp_dir itself, it is only readable by
+            # the minion and its mode would be kept in the copies
+            extract_dir = os.path.join(tmp_dir, "src")
+            os.mkdir(extract_dir)
+            os.chmod(extract_dir, 0o755)
+            with tarfile.open(archive) as tar:
+                if hasattr(tarfile, "data_filter"):
+                    tar.extractall(extract_dir, filter="data")
+                else:
+                    tar.extractall(extract_dir)
+
+            # archives of github contain a top level directory
+            tree = extract_dir
+            if not os.path.isfile(os.path.join(tree, "acme.sh")):
+                subdirs = [
+                    entry.path for entry in os.scandir(extract_dir) if entry.is_dir()
+                ]
+                if len(subdirs) != 1:
+                    raise CommandExecutionError(f"No acme.sh found in {source}")
+                tree = subdirs[0]
+        else:
+            __salt__["git.clone"](tmp_dir, url=source, name="acme.sh")
+            tree = os.path.join(tmp_dir, "acme.sh")
+            if source_rev:
+                __salt__["git.checkout"](tree, source_rev)
+            if source_hash:
+                _check_hash(os.path.join(tree, "acme.sh"), source_hash)
 
-    # check mode
-    possible_mode = ["standalone", "standalone-tls-alpn", "dns", "webroot"]
-    if not acme_mode in possible_mode:
-        raise SaltInvocationError(f"Acme mode {acme_mode} not supported")
+        if not os.path.isfile(os.path.join(tree, "acme.sh")):
+            raise CommandExecutionError(f"No acme.sh found in {source}")
 
-    # error when mode == webroot and webroot unset
-    if acme_mode == "webroot" and not webroot:
-        raise SaltInvocationError("Specify `webroot` path")
+        _write_manifest(tree)
+        os.rename(tree, path)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
 
-    # error when mode == dns and dns_plugin unset
-    if acme_mode == "dns" and not dns_plugin:
-        raise SaltInvocationError("Specify `dns_plugin`")
+    fresh.add(key)
+    log.debug("Cached acme.sh source %s in %s", source, path)
 
-    # error when dns mode an no credentials specified
+    return path
 
-    if acme_mode == "dns" and not isinstance(dns_credentials, dict):
-        raise SaltInvocationError("Specify `dns_credentials` as dict")
 
-    # build cmd
-    cmd = [
-        acme_bin,
-        "--issue",
-        "-d",
-        name,
-        "--server",
-        server,
-        "--keylength",
-        str(keysize),
-    ]
+def _install_from_source(user, args, source=None, source_hash=None, source_rev=None):
+    """
+    Run ./acme.sh with args as user in a copy of the cached source
+    """
 
-    # if aliases are specified
-    if aliases:
-        alias_cmd = []
-        for domain in aliases.split(","):
-            alias_cmd.extend(["-d", domain])
-        cmd.extend(alias_cmd)
+    src = _source_cache(source, source_hash, source_rev)
 
-    # if cert_path specified
-    if cert_path:
-        cmd.extend(["--cert-home", cert_path])
-    else:
-        cert_path = f"{home_dir}/.acme.sh"
+    # the cache is only readable by the minion, run acme.sh in a copy
+    work_dir = tempfile.mkdtemp(prefix=f"acme.sh-{user}-")
+    try:
+        os.chmod(work_dir, 0o755)
+        tree = os.path.join(work_dir, "acme.sh")
+        shutil.copytree(
+            src, tree, ignore=shutil.ignore_patterns(".git", _SOURCE_MANIFEST)
+        )
 
-    # modes
-    if acme_mode == "webroot":
-        cmd.extend(["-w", webroot])
-    elif acme_mode == "standalone":
-        cmd.append("--standalone")
-        if http_port:
-            cmd.extend(["--httpport", str(http_port)])
-    elif acme_mode == "standalone-tls-alpn":
-        cmd.append("--alpn")
-        if http_port:
-            cmd.extend(["--tlsport", http_port])
-    elif acme_mode == "dns":
-        cmd.extend(["--dns", dns_plugin])
+        cmd = ["./acme.sh"] + args
+        ret = _run_acme(cmd, user, "install", cwd=tree)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
 
-    # force
-    if force:
-        cmd.append("--force")
+    _cache("bin")["entries"].pop(user, None)
 
-    # validity
-    if valid_to:
-        cmd.extend(["--valid-to", valid_to])
-    if valid_from:
-        cmd.extend(["--valid-from", valid_from])
+    return ret
 
-    # insecure
-    if insecure:
-        cmd.append("--insecure")
 
-    if acme_mode == "dns":
-        log.debug("Set dns_credentials as temporary env")
-        __salt__["environ.setenv"](dns_credentials)
+def _read_conf(conf_path):
+    """
+    Parse an acme.sh domain conf without spawning acme.sh
 
-    issue_cmd = __salt__["cmd.run_all"](" ".join(cmd), python_shell=False, runas=user)
+    Returns the same key/value pairs as ``acme.sh --info`` or None,
+    if the file contains syntax the parser does not understand.
+    """
 
-    if issue_cmd["retcode"] == 0:
-        ret = _generate_crt_ret(name, cert_path)
-    else:
-        if issue_cmd["stdout"].find("Next renewal time is") != -1:
-            ret = (
-                f"Certificate in {cert_path}/{name} is valid, re run with `force=True`"
-            )
+    try:
+        with open(conf_path, encoding="utf-8") as conf_file:
+            lines = conf_file.read().splitlines()
+    except (OSError, UnicodeDecodeError) as err:
+        log.debug("Unable to read %s: %s", conf_path, err)
+        return None
+
+    conf = {"DOMAIN_CONF": conf_path}
+    for line in lines:
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+
+        match = _CONF_LINE.match(line)
+        if not match:
+            log.debug("Unknown syntax in %s: %s", conf_path, line)
+            return None
+        key, raw = match.groups()
+
+        # acme.sh writes values single quoted, older versions unquoted
+        if len(raw) >= 2 and raw[0] == raw[-1] == "'" and "'" not in raw[1:-1]:
+            value = raw[1:-1]
         elif (
-            issue_cmd["stdout"].find("acme.sh --register-account -m my@example.com")
-            != -1
+            len(raw) >= 2
+            and raw[0] == raw[-1] == '"'
+            and not re.search(r'[`$\\"]', raw[1:-1])
         ):
-            ret = "Please register your account: acme_sh.register my@example.com"
+            value = raw[1:-1]
+        elif _CONF_PLAIN_VALUE.match(raw):
+            value = raw
         else:
-            ret = issue_cmd
+            log.debug("Unknown value syntax in %s: %s", conf_path, line)
+            return None
 
-    return ret
+        if value.startswith(_B64CONF_START) and value.endswith(_B64CONF_END):
+            try:
+                value = base64.b64decode(
+                    value[len(_B64CONF_START) : -len(_B64CONF_END)], validate=True
+                ).decode("utf-8")
+            except (binascii.Error, UnicodeDecodeError):
+                log.debug("Invalid base64 value for %s in %s", key, conf_path)
+                return None
 
+        # acme.sh evaluates every assignment, the last one wins
+        conf[key] = value
 
-def list_crt(user="root", cert_path=None):
-    """
-    List all certificates in given cert_path
+    return conf
 
-    user
-      run the command as a specified user
-      default: root
 
-    cert_path
-      installation dir of certs
-      default = ~/.acme.sh
+def _generate_crt_ret(name, cert_path):
+    domain_dir = _domain_dir(cert_path, name)
+    return {
+        "certificate": f"{domain_dir}/{name}.cer",
+        "private_key": f"{domain_dir}/{name}.key",
+        "fullchain": f"{domain_dir}/fullchain.cer",
+        "ca": f"{domain_dir}/ca.cer",
+    }
+
+
+@contextlib.contextmanager
+def _db(name):
+    """
+    Connection to the sqlite database name in the minion cache dir
     """
 
-    home_dir = __salt__["user.info"](user)["home"]
+    db_dir = os.path.join(__opts__.get("cachedir", "/var/cache/salt/minion"), "acme_sh")
+    os.makedirs(db_dir, mode=0o700, exist_ok=True)
 
-    acme_bin = _get_acme_bin(home_dir)
+    conn = sqlite3.connect(
+        os.path.join(db_dir, f"{name}.sqlite"), timeout=30, isolation_level=None
+    )
+    try:
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.executescript(_DB_SCHEMAS[name])
+        yield conn
+    finally:
+        conn.close()
 
-    cmd = [acme_bin, "--list"]
 
-    if cert_path:
-        cmd.extend(["--cert-home", cert_path])
+def _rate_limits():
+    """
+    Limits of the ledger, merged with the acme_sh_ratelimits config
+    """
+
+    config = __salt__["config.get"]("acme_sh_ratelimits", {}) or {}
+    limits = {kind: dict(limit) for kind, limit in _RATE_LIMITS.items()}
+    for kind, limit in config.items():
+        if kind in limits and isinstance(limit, dict):
+            limits[kind].update(limit)
+    limits["max_wait"] = int(config.get("max_wait", 0) or 0)
+    return limits
+
+
+def _public_suffixes():
+    config = __salt__["config.get"]("acme_sh_ratelimits", {}) or {}
+    extra = config.get("public_suffixes") or []
+    return _PUBLIC_SUFFIXES | {x.strip(".").lower() for x in extra}
+
+
+def _registered_domain(domain, suffixes=_PUBLIC_SUFFIXES):
+    """
+    Registered domain of domain: one label more than its public suffix
+
+    Without the full public suffix list, the known suffixes in suffixes
+    are used, other domains are registered with their last two labels.
+    """
+
+    labels = domain.lstrip("*.").rstrip(".").lower().split(".")
+    for size in range(len(labels), 2, -1):
+        if ".".join(labels[-size + 1 :]) in suffixes:
+            return ".".join(labels[-size:])
+    return ".".join(labels[-2:])
+
+
+def _ledger_scopes(domains, renewal=False):
+    """
+    Rows of the ledger an order of domains counts for
+    """
+
+    scopes = [("orders", ""), ("duplicate", ",".join(sorted(set(domains))))]
+    if not renewal:
+        # renewals are exempt from the certificates per registered domain
+        suffixes = _public_suffixes()
+        scopes.extend(
+            ("domain", registered)
+            for registered in sorted({_registered_domain(d, suffixes) for d in domains})
+        )
+    return scopes
 
-    list_crt_cmd = __salt__["cmd.run_all"](
-        " ".join(cmd), python_shell=False, runas=user
+
+def _ledger_deferred(conn, server, account, kind, scope, hour, limit):
+    """
+    Return the first hour with space for one more order, None if it is now
+    """
+
+    if not limit["limit"]:
+        return None
+
+    rows = conn.execute(
+        "SELECT hour, count FROM ledger WHERE server = ? AND account = ? "
+        "AND kind = ? AND scope = ? AND hour > ? ORDER BY hour",
+        (server, account, kind, scope, hour - int(limit["hours"])),
+    ).fetchall()
+
+    total = sum(count for _, count in rows)
+    if total < int(limit["limit"]):
+        return None
+
+    # the oldest hours leave the window first
+    for row_hour, count in rows:
+        total -= count
+        if total < int(limit["limit"]):
+            return row_hour + int(limit["hours"])
+
+    return hour + int(limit["hours"])
+
+
+def _ledger_add(conn, server, account, kind, scope, hour, count=1):
+    conn.execute(
+        "INSERT INTO ledger (server, account, kind, scope, hour, count) "
+        "VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT (server, account, kind, scope, hour) "
+        "DO UPDATE SET count = count + excluded.count",
+        (server, account, kind, scope, hour, count),
     )
 
-    if list_crt_cmd["retcode"] == 0:
-        # map output
-        lines = list_crt_cmd["stdout"].strip().split("\n")
-        keys = lines[0].split()
-        ret = []
-        for line in lines[1:]:
-            values = line.split()
-            entry = dict(zip(keys, values))
-            ret.append(entry)
-    else:
-        ret = list_crt_cmd
 
-    return ret
+def _ledger_admit(server, user, domains, renewal=False):
+    """
+    Reserve an order in the ledger or return when it could be sent
 
+    Returns a ticket for _ledger_settle, or a dict with deferred_until if
+    a rate limit would be exceeded. Deferrals up to acme_sh_ratelimits:max_wait
+    seconds are waited for.
+    """
 
-def info(name, user="root", cert_path=None):
+    server = _directory_url(server)
+    limits = _rate_limits()
+    scopes = _ledger_scopes(domains, renewal)
+    # failed validations count per hostname
+    checks = scopes + [("failures", domain) for domain in domains]
+
+    while True:
+        hour = int(time.time() // 3600)
+        deferred = None
+        with _db("ledger") as conn:
+            # the immediate transaction makes check and reservation atomic
+            # for all threads and processes
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                for kind, scope in checks:
+                    until = _ledger_deferred(
+                        conn, server, user, kind, scope, hour, limits[kind]
+                    )
+                    if until is not None and (
+                        deferred is None or until > deferred["hour"]
+                    ):
+                        deferred = {"hour": until, "limit": kind, "scope": scope}
+
+                if deferred is None:
+                    for kind, scope in scopes:
+                        _ledger_add(conn, server, user, kind, scope, hour)
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+
+        if deferred is None:
+            return {"server": server, "user": user, "hour": hour, "scopes": scopes}
+
+        until = deferred["hour"] * 3600
+        wait = until - time.time()
+        if wait > limits["max_wait"]:
+            return {
+                "deferred_until": until,
+                "deferred_until_str": time.strftime(
+                    "%Y-%m-%dT%H:%M:%SZ", time.gmtime(until)
+                ),
+                "limit": deferred["limit"],
+                "scope": deferred["scope"] or server,
+            }
+
+        log.info(
+            "Rate limit %s of %s reached, wait %d seconds",
+            deferred["limit"],
+            deferred["scope"] or server,
+            wait,
+        )
+        time.sleep(max(wait, 0) + 1)
+
+
+def _ledger_settle(ticket, domains, ret, sent=True):
     """
-    Get info about a certificate
+    Book the result of an admitted order
+
+    Orders which were not sent to the server are released: orders refused
+    before acme.sh or the python client ran (sent is False) and orders
+    acme.sh skipped. Failed orders count as failed validation for every
+    domain.
+    """
+
+    if isinstance(ret, dict) and "certificate" in ret:
+        return
+
+    with _db("ledger") as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        if (
+            not sent
+            or ret is None
+            or (isinstance(ret, str) and any(x in ret for x in _LEDGER_SKIPPED))
+        ):
+            for kind, scope in ticket["scopes"]:
+                _ledger_add(
+                    conn,
+                    ticket["server"],
+                    ticket["user"],
+                    kind,
+                    scope,
+                    ticket["hour"],
+                    -1,
+                )
+        else:
+            # only issued certificates count for the domain limits
+            for kind, scope in ticket["scopes"]:
+                if kind != "orders":
+                    _ledger_add(
+                        conn,
+                        ticket["server"],
+                        ticket["user"],
+                        kind,
+                        scope,
+                        ticket["hour"],
+                        -1,
+                    )
+            hour = int(time.time() // 3600)
+            for domain in domains:
+                _ledger_add(
+                    conn, ticket["server"], ticket["user"], "failures", domain, hour
+                )
+        conn.execute("COMMIT")
+
+
+def _ledger_retry(ticket, domains):
+    """
+    Book the failed attempt of an admitted order before it is retried
+
+    The attempt counts as failed validation for every domain and the retry
+    as another order. Returns False if the retry would exceed a rate limit.
+    """
+
+    limits = _rate_limits()
+    hour = int(time.time() // 3600)
+    orders = [scope for scope in ticket["scopes"] if scope[0] == "orders"]
+    with _db("ledger") as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            for domain in domains:
+                _ledger_add(
+                    conn, ticket["server"], ticket["user"], "failures", domain, hour
+                )
+            allowed = all(
+                _ledger_deferred(
+                    conn,
+                    ticket["server"],
+                    ticket["user"],
+                    kind,
+                    scope,
+                    hour,
+                    limits[kind],
+                )
+                is None
+                for kind, scope in orders + [("failures", d) for d in domains]
+            )
+            if allowed:
+                for kind, scope in orders:
+                    _ledger_add(
+                        conn, ticket["server"], ticket["user"], kind, scope, hour
+                    )
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+    return allowed
 
-    name
-      Common name of the certificate (main_domain)
+
+def ratelimit_status(domains, server="letsencrypt", user="root"):
+    """
+    Show the usage of the rate limit ledger for an order of domains
+
+    domains
+      comma separated domains of the order
+
+    server
+      acme server
+      default: letsencrypt
 
     user
-      run the command as a specified user
+      account of the orders
       default: root
+    """
 
-    cert_path
-      installation dir of certs
-      default: ~/.acme.sh
+    domains = [d for d in domains.split(",") if d]
+    directory = _directory_url(server)
+    hour = int(time.time() // 3600)
+    limits = _rate_limits()
+
+    ret = {}
+    with _db("ledger") as conn:
+        for kind, scope in _ledger_scopes(domains) + [
+            ("failures", domain) for domain in domains
+        ]:
+            (used,) = conn.execute(
+                "SELECT COALESCE(SUM(count), 0) FROM ledger WHERE server = ? "
+                "AND account = ? AND kind = ? AND scope = ? AND hour > ?",
+                (directory, user, kind, scope, hour - int(limits[kind]["hours"])),
+            ).fetchone()
+            ret.setdefault(kind, {})[scope or directory] = {
+                "used": used,
+                "limit": limits[kind]["limit"],
+                "hours": limits[kind]["hours"],
+            }
+
+    return ret
+
+
+def _server_label(server):
+    if not server:
+        return ""
+    for name, directory in _ACME_SERVERS.items():
+        if server in (name, directory):
+            return name
+    return server.split("://", 1)[-1].split("/", 1)[0]
+
+
+def _classify_failure(cmd_ret):
+    """
+    Class of a failed acme.sh call, None if it succeeded
     """
 
-    if "acme_sh.info" not in __context__:
-        __context__["acme_sh.info"] = {"code": 0}
+    if cmd_ret["retcode"] == 0:
+        return None
 
-    home_dir = __salt__["user.info"](user)["home"]
+    output = f"{cmd_ret.get('stdout', '')}\n{cmd_ret.get('stderr', '')}"
+    for failure_class, pattern in _FAILURE_CLASSES:
+        if pattern.search(output):
+            return failure_class
+    return "error"
 
-    acme_bin = _get_acme_bin(home_dir)
 
-    cmd = [acme_bin, "--info", "--domain", name]
+def _metric_labels(values):
+    return ",".join(
+        '{}="{}"'.format(key, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+        for key, value in values
+    )
 
-    if cert_path:
-        cmd.extend(["--cert-home", cert_path])
-    else:
-        cert_path = f"{home_dir}/.acme.sh"
 
-    # check if cert_path exists
-    if not __salt__["file.directory_exists"](cert_path):
-        __context__["acme_sh.info"]["code"] = 1
-        __context__["retcode"] = 1
-        return f"Certificate path {cert_path} does not exist"
-    # check if cert exists
-    if not __salt__["file.directory_exists"](f"{cert_path}/{name}"):
-        __context__["acme_sh.info"]["code"] = 1
-        __context__["retcode"] = 1
-        return f"Certificate {name} does not exist"
+def _write_textfile(textfile, metric):
+    """
+    Add metric to the persisted histogram and write the textfile of it
+    """
 
-    info_cmd = __salt__["cmd.run_all"](" ".join(cmd), python_shell=False, runas=user)
+    db_dir = os.path.join(__opts__.get("cachedir", "/var/cache/salt/minion"), "acme_sh")
+    os.makedirs(db_dir, mode=0o700, exist_ok=True)
+    state_path = os.path.join(db_dir, "metrics.json")
+
+    with open(os.path.join(db_dir, "metrics.lock"), "w") as lock:
+        # every salt job is a process, the lock serializes them
+        fcntl.flock(lock, fcntl.LOCK_EX)
+
+        try:
+            with open(state_path, encoding="utf-8") as state_file:
+                state = json.load(state_file)
+        except (OSError, ValueError):
+            state = {"durations": {}, "failures": {}, "last": {}}
+
+        labels = json.dumps(
+            [
+                ["function", metric["function"]],
+                ["server", metric["server"]],
+                ["mode", metric["mode"]],
+                ["outcome", metric["outcome"]],
+            ]
+        )
+        histogram = state["durations"].setdefault(
+            labels, {"buckets": [0] * len(_METRIC_BUCKETS), "sum": 0, "count": 0}
+        )
+        for i, bucket in enumerate(_METRIC_BUCKETS):
+            if metric["duration"] <= bucket:
+                histogram["buckets"][i] += 1
+        histogram["sum"] += metric["duration"]
+        histogram["count"] += 1
+        state["last"][labels] = int(time.time())
+
+        if metric["failure"] and metric["failure"] != "skipped":
+            failure_labels = json.dumps(
+                [
+                    ["function", metric["function"]],
+                    ["server", metric["server"]],
+                    ["mode", metric["mode"]],
+                    ["class", metric["failure"]],
+                ]
+            )
+            state["failures"][failure_labels] = (
+                state["failures"].get(failure_labels, 0) + 1
+            )
 
-    if info_cmd["retcode"] == 0:
-        # map output to dict
-        info_dict = {}
-        lines = info_cmd["stdout"].strip().split("\n")
-        for line in lines:
-            key, value = line.split("=")
-            info_dict[key] = value
+        _atomic_write(state_path, json.dumps(state), 0o600)
+
+        lines = [
+            "# HELP acme_sh_duration_seconds Duration of acme.sh calls",
+            "# TYPE acme_sh_duration_seconds histogram",
+        ]
+        for labels, histogram in sorted(state["durations"].items()):
+            label_str = _metric_labels(json.loads(labels))
+            for bucket, count in zip(_METRIC_BUCKETS, histogram["buckets"]):
+                lines.append(
+                    f'acme_sh_duration_seconds_bucket{{{label_str},le="{bucket}"}} {count}'
+                )
+            lines.append(
+                f'acme_sh_duration_seconds_bucket{{{label_str},le="+Inf"}} '
+                f'{histogram["count"]}'
+            )
+            lines.append(
+                f"acme_sh_duration_seconds_sum{{{label_str}}} {histogram['sum']}"
+            )
+            lines.append(
+                f"acme_sh_duration_seconds_count{{{label_str}}} {histogram['count']}"
+            )
 
-        ret = info_dict
+        lines += [
+            "# HELP acme_sh_failures_total Failed acme.sh calls by failure class",
+            "# TYPE acme_sh_failures_total counter",
+        ]
+        for labels, count in sorted(state["failures"].items()):
+            lines.append(
+                f"acme_sh_failures_total{{{_metric_labels(json.loads(labels))}}} {count}"
+            )
+
+        lines += [
+            "# HELP acme_sh_last_run_timestamp_seconds Time of the last acme.sh call",
+            "# TYPE acme_sh_last_run_timestamp_seconds gauge",
+        ]
+        for labels, timestamp in sorted(state["last"].items()):
+            lines.append(
+                "acme_sh_last_run_timestamp_seconds"
+                f"{{{_metric_labels(json.loads(labels))}}} {timestamp}"
+            )
+
+        _atomic_write(textfile, "\n".join(lines) + "\n", 0o644)
+
+
+def _record_metric(
+    function, duration, retcode, failure, domain=None, mode=None, server=None
+):
+    """
+    Keep the timing of an acme.sh call in __context__ and export it
+
+    Exports are configured in acme_sh_metrics, see the documentation.
+    """
+
+    metric = {
+        "function": function,
+        "domain": domain or "",
+        "mode": mode or "",
+        "server": _server_label(server),
+        "duration": round(duration, 3),
+        "retcode": retcode,
+        "failure": failure,
+        "outcome": "success" if failure is None else "failure",
+    }
+    if failure == "skipped":
+        metric["outcome"] = "skipped"
+
+    __context__.setdefault("acme_sh.metrics", []).append(metric)
+    log.debug("acme.sh %s %s took %.3fs", function, domain or "", duration)
+
+    config = __salt__["config.get"]("acme_sh_metrics", {}) or {}
+    if config.get("textfile"):
+        try:
+            _write_textfile(config["textfile"], metric)
+        except OSError as err:
+            log.warning("Unable to write %s: %s", config["textfile"], err)
+    if config.get("events"):
+        __salt__["event.send"](f"acme_sh/metrics/{function}", metric)
+
+    return metric
+
+
+def _backoff_delay(attempt):
+    """
+    Jittered exponential backoff of the attempt, starting with 0
+    """
+
+    return random.uniform(0, min(_RETRY_MAX_DELAY, _RETRY_BASE_DELAY * 2**attempt))
+
+
+def _retry_policy(retries, retry_budget):
+    """
+    Retries and budget, unset values are taken from the acme_sh_retry config
+    """
+
+    config = __salt__["config.get"]("acme_sh_retry", {}) or {}
+    if retries is None:
+        retries = config.get("retries", 2)
+    if retry_budget is None:
+        retry_budget = config.get("budget", 300)
+    return int(retries), float(retry_budget)
+
+
+def _with_retries(run, retries=None, retry_budget=None, on_retry=None):
+    """
+    Call run until its acme.sh result does not fail transiently
+
+    Transient failures are retried up to retries times with jittered
+    exponential backoff, as long as the retry starts within retry_budget
+    seconds. Other failures are returned immediately. on_retry is called
+    before every retry, the retry is skipped if it returns False.
+    """
+
+    retries, retry_budget = _retry_policy(retries, retry_budget)
+    start = time.monotonic()
+    attempt = 0
+    while True:
+        cmd_ret = run()
+        failure = _classify_failure(cmd_ret)
+        if failure not in _TRANSIENT_FAILURES or attempt >= retries:
+            return cmd_ret
+
+        delay = _backoff_delay(attempt)
+        if time.monotonic() - start + delay > retry_budget:
+            log.info("Retry budget of %ss exhausted", retry_budget)
+            return cmd_ret
+
+        if on_retry is not None and not on_retry():
+            log.info("A retry would exceed the rate limits")
+            return cmd_ret
+
+        attempt += 1
+        log.info(
+            "acme.sh failed with a %s failure, retry %s/%s in %.1fs",
+            failure,
+            attempt,
+            retries,
+            delay,
+        )
+        time.sleep(delay)
+
+
+def _trace_phase(line):
+    for phase, pattern in _TRACE_PHASES:
+        if pattern.search(line):
+            return phase
+    return None
+
+
+def _run_traced(cmd, user, env=None):
+    """
+    Run acme.sh and read its output line by line while it runs
+
+    Only the last _TRACE_LINES lines of stdout and stderr are kept.
+    Returns a result like cmd.run_all with the phases as trace.
+    """
+
+    uid, gid = _user_ids(user)
+    home = _home_dir(user)
+    proc_env = dict(os.environ, HOME=home, USER=user, LOGNAME=user)
+    proc_env.update(env or {})
+
+    # Popen drops the privileges itself, no python code may run between
+    # fork and exec in the threads of issue_many
+    demote = {}
+    if os.getuid() != uid:
+        demote = {
+            "user": uid,
+            "group": gid,
+            "extra_groups": os.getgrouplist(user, gid),
+        }
+
+    lines = deque(maxlen=_TRACE_LINES)
+    phases = []
+    start = time.monotonic()
+    with subprocess.Popen(
+        cmd,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        cwd=home,
+        env=proc_env,
+        text=True,
+        errors="replace",
+        **demote,
+    ) as proc:
+        for line in proc.stdout:
+            line = line.rstrip("\n")
+            lines.append(line)
+            phase = _trace_phase(line)
+            if phase is None or (phases and phases[-1]["phase"] == phase):
+                continue
+            offset = round(time.monotonic() - start, 3)
+            if phases:
+                phases[-1]["duration"] = round(offset - phases[-1]["start"], 3)
+            phases.append({"phase": phase, "start": offset})
+        retcode = proc.wait()
+
+    total = round(time.monotonic() - start, 3)
+    if phases:
+        phases[-1]["duration"] = round(total - phases[-1]["start"], 3)
+
+    durations = {}
+    for phase in phases:
+        durations[phase["phase"]] = round(
+            durations.get(phase["phase"], 0) + phase["duration"], 3
+        )
+    trace = {"phases": phases, "durations": durations, "total": total}
+    log.debug("Trace of %s: %s", cmd[0], durations)
+
+    # like cmd.run_all
+    __context__["retcode"] = retcode
+
+    return {
+        "pid": proc.pid,
+        "retcode": retcode,
+        "stdout": "\n".join(lines),
+        "stderr": "",
+        "trace": trace,
+    }
+
+
+def _run_acme(
+    cmd,
+    user,
+    function,
+    domain=None,
+    mode=None,
+    server=None,
+    trace=False,
+    **kwargs,
+):
+    """
+    Run an acme.sh command with cmd.run_all and record its duration and outcome
+
+    With trace, the output is read while acme.sh runs, see _run_traced.
+    """
+
+    kwargs.setdefault("python_shell", False)
+    if function in ("issue", "renew"):
+        _ORDER_STATE.sent = True
+    start = time.monotonic()
+    if trace:
+        cmd_ret = _run_traced(cmd, user, env=kwargs.get("env"))
     else:
-        ret = info_cmd
+        cmd_ret = __salt__["cmd.run_all"](" ".join(cmd), runas=user, **kwargs)
+    _record_metric(
+        function,
+        time.monotonic() - start,
+        cmd_ret["retcode"],
+        _classify_failure(cmd_ret),
+        domain=domain,
+        mode=mode,
+        server=server,
+    )
+    return cmd_ret
 
-    return ret
+
+def _record_python(function, start, ret, domain=None, mode=None, server=None):
+    """
+    Record the timing of a python backend call, ret is its return value
+    """
+
+    if isinstance(ret, dict):
+        retcode, failure = 0, None
+    else:
+        retcode = 1
+        failure = _classify_failure({"retcode": retcode, "stdout": str(ret)})
+    _record_metric(
+        function,
+        time.monotonic() - start,
+        retcode,
+        failure,
+        domain=domain,
+        mode=mode,
+        server=server,
+    )
 
 
-def renew(name, user="root", cert_path=None, force=False, insecure=False):
+def install(
+    email,
+    user="root",
+    upgrade=False,
+    force=False,
+    source=None,
+    source_hash=None,
+    source_rev=None,
+):
     """
-    Renew a certificate
+    Install acme.sh
 
-    name
-      Common name of the certificate (main_domain)
+    email
+      used to register an account to acme server, you will receive a renewal notice email here
 
     user
-      run the command as a specified user
+      user to install
       default: root
 
-    cert_path
-      installation dir of certs
-      default: ~/.acme.sh
+    upgrade
+      upgrade acme.sh
+      default: False
 
     force
-      force renewing a certificate
+      force installation
       default: False
 
-    insecure
-      disable ssl verification
-      default: False
-    """
+    source
+      git repository, local mirror or tarball (path or url) of acme.sh,
+      the source is cached once on the minion and shared by all users
+      default: https://github.com/acmesh-official/acme.sh
 
-    home_dir = __salt__["user.info"](user)["home"]
+    source_hash
+      sha256 of the tarball, for git sources sha256 of the acme.sh script
 
-    acme_bin = _get_acme_bin(home_dir)
+    source_rev
+      git revision to install, e.g. a tag or commit
+    """
 
-    cmd = [acme_bin, "--renew", "--domain", name]
+    home_dir = _home_dir(user)
+    script_path = f"{home_dir}/.acme.sh/acme.sh"
 
-    if cert_path:
-        cmd.extend(["--cert-home", cert_path])
-    else:
-        cert_path = f"{home_dir}/.acme.sh"
+    # if already installed
+    if __salt__["file.file_exists"](script_path):
+        if upgrade:
+            return _upgrade(user, source, source_hash, source_rev)
 
-    if force:
-        cmd.append("--force")
+        if not force:
+            return "Already installed, re-run with force=True to force installation"
 
-    if insecure:
-        cmd.append("--insecure")
+    cmd = ["--install", "--accountemail", email, "--nocron"]
 
-    renew_cmd = __salt__["cmd.run_all"](" ".join(cmd), python_shell=False, runas=user)
+    install_cmd = _install_from_source(user, cmd, source, source_hash, source_rev)
 
-    if renew_cmd["retcode"] == 0:
-        ret = _generate_crt_ret(name, cert_path)
+    # check install process successfully
+    if install_cmd["retcode"] == 0:
+        log.debug("acme.sh successfully installed")
     else:
-        next_renew = re.search(r"Next renewal time is: (.*)", renew_cmd["stdout"])
-        if next_renew:
-            ret = f"Next renewal time is {next_renew.group(1)}, add force=True to renew"
-        elif renew_cmd["stdout"].find("is not an issued domain, skip") != -1:
-            ret = f"Domain {name} is not an issued domain"
-        else:
-            ret = renew_cmd
+        __context__["retcode"] = 1
+        return "Installation failed, see logfiles for more information"
 
-    return ret
+    return f"acme.sh successfully installed in {os.path.dirname(script_path)}"
 
 
-def version(user="root"):
+def register(email, user="root"):
     """
-    Get version of acme.sh
+    Register account @ zeroSSL CA
+    This step is required if you are using zeroSSL CA
+
+    email
+      email to register
 
     user
       run the command as a specified user
       default: root
     """
 
-    home_dir = __salt__["user.info"](user)["home"]
+    acme_bin = _acme_bin(user)
 
-    acme_bin = _get_acme_bin(home_dir)
+    cmd = [acme_bin, "--register-account", "-m", email]
 
-    cmd = [acme_bin, "--version"]
+    register_cmd = _run_acme(cmd, user, "register")
 
-    version_cmd = __salt__["cmd.run_all"](" ".join(cmd), python_shell=False, runas=user)
+    if register_cmd["retcode"] == 0:
+        match = re.search(r"ACCOUNT_THUMBPRINT='([^']+)'", register_cmd["stdout"])
+        if match:
+            ret = {"account_thumbprint": match.group(1)}
+        else:
+            __context__["retcode"] = 1
+            ret = "Account registration failed"
 
-    if version_cmd["retcode"] == 0:
-        ret = re.search(r"v(.*)", version_cmd["stdout"]).group(1)
-    else:
+    return ret
+
+
+def issue(
+    name,
+    acme_mode,
+    aliases=None,
+    server="letsencrypt",
+    keysize="4096",
+    dns_plugin=None,
+    webroot=None,
+    http_port=None,
+    user="root",
+    cert_path=None,
+    dns_credentials=None,
+    force=False,
+    valid_to=None,
+    valid_from=None,
+    insecure=False,
+    dnssleep=None,
+    responder=False,
+    backend="acme.sh",
+    keypool=0,
+    trace=False,
+    retries=None,
+    retry_budget=None,
+):
+    """
+    Obtain a certificate
+
+    name
+      Common name of the certificate
+
+    acme_mode
+      choose one acme mode (webroot, standalone, standalone-tls-alpn, dns)
+
+    aliases
+      comma seperated, subjectAltNames
+
+    server
+      acme server
+      default = letsencrypt
+
+    keysize
+      RSA key bits
+      default = 4096
+      possible values:
+        ec-256 (prime256v1, "ECDSA P-256", which is the default key type)
+        ec-384 (secp384r1, "ECDSA P-384")
+        ec-521 (secp521r1, "ECDSA P-521", which is not supported by Let's Encrypt yet.)
+        2048 (RSA2048)
+        3072 (RSA3072)
+        4096 (RSA4096)
+
+    dns_plugin
+      dns plugin to use
+      see https://github.com/acmesh-official/acme.sh/wiki/dnsapi
+
+    webroot
+      if acme_mode == webroot, full path to webroot
+
+    http_port
+      the port the server listen on during standalone or standalone-tls-alpn
+
+    user
+      run the command as a specified user
+      default: root
+
+    cert_path
+      installation dir of certs
+      default = ~/.acme.sh
+
+    dns_credentials
+      dns crededentials as python dict
+      see https://github.com/acmesh-official/acme.sh/wiki/dnsapi
+
+    force
+      force issuing a certificate
+      default = False
+
+    valid_to
+      NotAfter field in cert
+      see https://github.com/acmesh-official/acme.sh/wiki/Validity
+
+    valid_from
+      NotBefore field in cert
+      see https://github.com/acmesh-official/acme.sh/wiki/Validity
+
+    insecure
+      disable ssl verification
+      default: False
+
+    dnssleep
+      seconds to wait for the dns records instead of checking them,
+      only used when acme_mode == dns
+
+    responder
+      answer http-01 challenges with the built-in responder on http_port
+      instead of acme.sh and socat, only used when acme_mode == standalone
+      default: False
+
+    backend
+      acme.sh or python, the python backend talks to the acme server
+      directly and supports the webroot and standalone modes
+      default: acme.sh
+
+    keypool
+      take new private keys from the key pool of user, which is filled
+      by acme_sh.keypool_fill, the acme_sh.cert state refills it up to this
+      number of keys in runs without an order
+      default: 0 (generate the key during the issue)
+
+    trace
+      read the output of acme.sh while it runs and add the durations of
+      its phases (account, new-order, authorization, challenge publish,
+      propagation wait, validation, finalize, download) as trace,
+      only the acme.sh backend is traced
+      default: False
+
+    retries
+      retries of acme.sh after a network failure, failed validations
+      are not retried, see acme_sh_retry
+      default: 2
+
+    retry_budget
+      seconds within the retries have to start
+      default: 300
+    """
+
+    return _issue(
+        name,
+        acme_mode,
+        aliases=aliases,
+        server=server,
+        keysize=keysize,
+        dns_plugin=dns_plugin,
+        webroot=webroot,
+        http_port=http_port,
+        user=user,
+        cert_path=cert_path,
+        dns_credentials=dns_credentials,
+        force=force,
+        valid_to=valid_to,
+        valid_from=valid_from,
+        insecure=insecure,
+        dnssleep=dnssleep,
+        responder=responder,
+        backend=backend,
+        keypool=keypool,
+        trace=trace,
+        retries=retries,
+        retry_budget=retry_budget,
+        env=_dns_env(dns_credentials),
+    )
+
+
+def _dns_env(dns_credentials):
+    """
+    Environment for a single acme.sh process, the minion env stays untouched
+    """
+
+    if not isinstance(dns_credentials, dict) or not dns_credentials:
+        return None
+
+    return {str(key): str(value) for key, value in dns_credentials.items()}
+
+
+class _ChallengeResponder:
+    """
+    Minimal asyncio http server for ACME http-01 challenges
+
+    With acme.sh --stateless the key authorization of every token is
+    ``<token>.<account thumbprint>``, so one server can answer the
+    challenges of any number of parallel orders of the same account.
+    """
+
+    def __init__(self, port):
+        self.port = port
+        self.thumbprint = None
+        # explicit key authorizations of the python backend
+        self.tokens = {}
+        self.users = 0
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(
+            target=self._loop.run_forever, name=f"acme_sh-http-{port}", daemon=True
+        )
+        self._server = None
+
+    def start(self):
+        self._thread.start()
+        future = asyncio.run_coroutine_threadsafe(
+            asyncio.start_server(self._handle, port=self.port, reuse_address=True),
+            self._loop,
+        )
+        try:
+            self._server = future.result(timeout=10)
+        except OSError as err:
+            self._shutdown()
+            raise CommandExecutionError(
+                f"Unable to listen on port {self.port}: {err}"
+            ) from err
+        log.debug("Challenge responder listens on port %s", self.port)
+
+    def stop(self):
+        async def _close():
+            self._server.close()
+            await self._server.wait_closed()
+
+        asyncio.run_coroutine_threadsafe(_close(), self._loop).result(timeout=10)
+        self._shutdown()
+        log.debug("Challenge responder on port %s stopped", self.port)
+
+    def _shutdown(self):
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join(timeout=10)
+        self._loop.close()
+
+    def key_authorization(self, token):
+        if token in self.tokens:
+            return self.tokens[token]
+        if self.thumbprint:
+            return f"{token}.{self.thumbprint}"
+        return None
+
+    async def _handle(self, reader, writer):
+        try:
+            request = await asyncio.wait_for(reader.readline(), timeout=10)
+            # skip the headers
+            while True:
+                line = await asyncio.wait_for(reader.readline(), timeout=10)
+                if line in (b"\r\n", b"\n", b""):
+                    break
+
+            parts = request.decode("latin-1").split()
+            body = None
+            if len(parts) >= 2 and parts[0] in ("GET", "HEAD"):
+                match = _CHALLENGE_PATH.match(parts[1])
+                if match:
+                    body = self.key_authorization(match.group(1))
+
+            if body is None:
+                status, body = "404 Not Found", ""
+            else:
+                status = "200 OK"
+                log.debug("Answer http-01 challenge %s", parts[1])
+
+            data = body.encode()
+            writer.write(
+                (
+                    f"HTTP/1.1 {status}\r\n"
+                    "Content-Type: text/plain\r\n"
+                    f"Content-Length: {len(data)}\r\n"
+                    "Connection: close\r\n\r\n"
+                ).encode()
+            )
+            if parts and parts[0] != "HEAD":
+                writer.write(data)
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError, UnicodeDecodeError) as err:
+            log.debug("Challenge responder request failed: %s", err)
+        finally:
+            writer.close()
+
+
+@contextlib.contextmanager
+def _challenge_responder(port, thumbprint=None):
+    """
+    Share one running challenge responder per port between all callers
+    """
+
+    with _RESPONDERS_LOCK:
+        responder = _RESPONDERS.get(port)
+        if responder is None:
+            responder = _ChallengeResponder(port)
+            responder.start()
+            _RESPONDERS[port] = responder
+        if thumbprint:
+            if responder.thumbprint and responder.thumbprint != thumbprint:
+                raise CommandExecutionError(
+                    f"Port {port} is already used for the challenges of another account"
+                )
+            responder.thumbprint = thumbprint
+        responder.users += 1
+
+    try:
+        yield responder
+    finally:
+        with _RESPONDERS_LOCK:
+            responder.users -= 1
+            if not responder.users:
+                responder.stop()
+                del _RESPONDERS[port]
+
+
+def _account_thumbprint(user, server, insecure=False):
+    """
+    Return the thumbprint of the acme account of user at server
+    """
+
+    def _register():
+        cmd = [_acme_bin(user), "--register-account", "--server", server]
+        if insecure:
+            cmd.append("--insecure")
+
+        register_cmd = _run_acme(cmd, user, "register", server=server)
+        match = re.search(r"ACCOUNT_THUMBPRINT='([^']+)'", register_cmd["stdout"])
+        if register_cmd["retcode"] != 0 or not match:
+            raise CommandExecutionError(f"Unable to get the account of {server}")
+
+        return match.group(1)
+
+    return _cached("thumbprint", (user, server), _register)
+
+
+def _issue(name, acme_mode, aliases=None, server="letsencrypt", user="root", **kwargs):
+    """
+    Issue a certificate within the rate limits of the ledger,
+    see _run_issue for the arguments
+    """
+
+    domains = [name] + [alias for alias in (aliases or "").split(",") if alias]
+    ticket = _ledger_admit(server, user, domains)
+    if "deferred_until" in ticket:
+        __context__["retcode"] = 1
+        return ticket
+
+    _ORDER_STATE.sent = False
+    ret = None
+    try:
+        ret = _run_issue(
+            name,
+            acme_mode,
+            aliases=aliases,
+            server=server,
+            user=user,
+            on_retry=lambda: _ledger_retry(ticket, domains),
+            **kwargs,
+        )
+    finally:
+        _ledger_settle(ticket, domains, ret, _ORDER_STATE.sent)
+
+    if isinstance(ret, dict) and "certificate" in ret:
+        _inventory_update(name, user, kwargs.get("cert_path"))
+
+    return ret
+
+
+def _run_issue(
+    name,
+    acme_mode,
+    aliases=None,
+    server="letsencrypt",
+    keysize="4096",
+    dns_plugin=None,
+    webroot=None,
+    http_port=None,
+    user="root",
+    cert_path=None,
+    dns_credentials=None,
+    force=False,
+    valid_to=None,
+    valid_from=None,
+    insecure=False,
+    dnssleep=None,
+    responder=False,
+    backend="acme.sh",
+    keypool=0,
+    trace=False,
+    retries=None,
+    retry_budget=None,
+    env=None,
+    on_retry=None,
+):
+    """
+    Run acme.sh --issue, see issue for the arguments
+
+    env
+      additional environment of the acme.sh process
+    """
+
+    if backend == "python":
+        _check_python_backend()
+        start = time.monotonic()
+        try:
+            ret = _python_issue(
+                name,
+                acme_mode,
+                aliases=aliases,
+                server=server,
+                keysize=keysize,
+                webroot=webroot,
+                http_port=http_port,
+                user=user,
+                cert_path=cert_path,
+                force=force,
+                valid_to=valid_to,
+                valid_from=valid_from,
+                insecure=insecure,
+                keypool=keypool,
+            )
+            __context__["retcode"] = 0
+        except (CommandExecutionError, requests.RequestException) as err:
+            __context__["retcode"] = 1
+            ret = str(err)
+        _record_python("issue", start, ret, domain=name, mode=acme_mode, server=server)
+        return ret
+    elif backend != "acme.sh":
+        raise SaltInvocationError(f"Backend {backend} not supported")
+
+    # the built-in responder only serves http-01
+    responder = responder and acme_mode == "standalone"
+
+    if (
+        acme_mode == "standalone" or acme_mode == "standalone-tls-alpn"
+    ) and not responder:
+        # check socat is installed, when standalone
+        if not salt.utils.path.which_bin(["socat"]):
+            __context__["retcode"] = 1
+            return "Install socat to use standalone mode first"
+
+    acme_bin = _acme_bin(user)
+
+    # check keysize
+    possible_keylength = ["ec-256", "ec-384", "ec-521", "2048", "3072", "4096"]
+    if keysize not in possible_keylength:
+        raise SaltInvocationError(f"Keysize {keysize} not supported")
+
+    # check mode
+    possible_mode = ["standalone", "standalone-tls-alpn", "dns", "webroot"]
+    if not acme_mode in possible_mode:
+        raise SaltInvocationError(f"Acme mode {acme_mode} not supported")
+
+    # error when mode == webroot and webroot unset
+    if acme_mode == "webroot" and not webroot:
+        raise SaltInvocationError("Specify `webroot` path")
+
+    # error when mode == dns and dns_plugin unset
+    if acme_mode == "dns" and not dns_plugin:
+        raise SaltInvocationError("Specify `dns_plugin`")
+
+    # error when dns mode an no credentials specified
+
+    if acme_mode == "dns" and not isinstance(dns_credentials, dict):
+        raise SaltInvocationError("Specify `dns_credentials` as dict")
+
+    # a pooled key is passed to acme.sh as csr
+    csr_file = key_pem = None
+    if keypool:
+        csr_file, key_pem = _keypool_csr(
+            name,
+            aliases,
+            keysize,
+            user,
+            _default_cert_path(user, cert_path),
+            keypool,
+        )
+
+    # build cmd
+    if csr_file:
+        cmd = [acme_bin, "--signcsr", "--csr", csr_file, "--server", server]
+    else:
+        cmd = [
+            acme_bin,
+            "--issue",
+            "-d",
+            name,
+            "--server",
+            server,
+            "--keylength",
+            str(keysize),
+        ]
+
+        # if aliases are specified
+        if aliases:
+            alias_cmd = []
+            for domain in aliases.split(","):
+                alias_cmd.extend(["-d", domain])
+            cmd.extend(alias_cmd)
+
+    # if cert_path specified
+    if cert_path:
+        cmd.extend(["--cert-home", cert_path])
+    else:
+        cert_path = _default_cert_path(user, cert_path)
+
+    # modes
+    if acme_mode == "webroot":
+        cmd.extend(["-w", webroot])
+    elif acme_mode == "standalone" and responder:
+        cmd.append("--stateless")
+    elif acme_mode == "standalone":
+        cmd.append("--standalone")
+        if http_port:
+            cmd.extend(["--httpport", str(http_port)])
+    elif acme_mode == "standalone-tls-alpn":
+        cmd.append("--alpn")
+        if http_port:
+            cmd.extend(["--tlsport", http_port])
+    elif acme_mode == "dns":
+        cmd.extend(["--dns", dns_plugin])
+        if dnssleep is not None:
+            cmd.extend(["--dnssleep", str(int(dnssleep))])
+
+    # force
+    if force:
+        cmd.append("--force")
+
+    # validity
+    if valid_to:
+        cmd.extend(["--valid-to", valid_to])
+    if valid_from:
+        cmd.extend(["--valid-from", valid_from])
+
+    # insecure
+    if insecure:
+        cmd.append("--insecure")
+
+    labels = {
+        "domain": name,
+        "mode": dns_plugin if acme_mode == "dns" else acme_mode,
+        "server": server,
+    }
+
+    def _run():
+        return _run_acme(cmd, user, "issue", trace=trace, env=env, **labels)
+
+    try:
+        if responder:
+            thumbprint = _account_thumbprint(user, server, insecure)
+            with _challenge_responder(int(http_port or 80), thumbprint):
+                issue_cmd = _with_retries(_run, retries, retry_budget, on_retry)
+        else:
+            issue_cmd = _with_retries(_run, retries, retry_budget, on_retry)
+    finally:
+        if csr_file:
+            os.remove(csr_file)
+    _info_cache_invalidate(name, user, cert_path)
+
+    if issue_cmd["retcode"] == 0:
+        if key_pem:
+            _keypool_install(name, keysize, user, cert_path, key_pem)
+        ret = _generate_crt_ret(name, cert_path)
+        if trace:
+            ret["trace"] = issue_cmd["trace"]
+    else:
+        if issue_cmd["stdout"].find("Next renewal time is") != -1:
+            ret = (
+                f"Certificate in {cert_path}/{name} is valid, re run with `force=True`"
+            )
+        elif (
+            issue_cmd["stdout"].find("acme.sh --register-account -m my@example.com")
+            != -1
+        ):
+            ret = "Please register your account: acme_sh.register my@example.com"
+        else:
+            ret = issue_cmd
+
+    return ret
+
+
+def issue_many(
+    specs, concurrency=4, per_server=2, dns_batch=False, batch_size=20, dnssleep=None
+):
+    """
+    Obtain multiple certificates in parallel
+
+    Returns a dict with the name of every spec as key and the result
+    of acme_sh.issue as value.
+
+    specs
+      list of dicts with the arguments of acme_sh.issue,
+      e.g. [{"name": "example.com", "acme_mode": "dns", ...}]
+
+    concurrency
+      maximum number of acme.sh processes at the same time
+      default: 4
+
+    per_server
+      maximum number of acme.sh processes per acme server at the same time
+      default: 2
+
+    dns_batch
+      group dns specs by user, dns_plugin and dns_credentials and start
+      all orders of a group at once, so the propagation waits overlap
+      default: False
+
+    batch_size
+      maximum number of orders started at once per dns group,
+      at most concurrency and per_server
+      default: 20
+
+    dnssleep
+      seconds to wait for the dns records in a dns group,
+      see acme_sh.issue
+    """
+
+    if not isinstance(specs, list) or not all(isinstance(x, dict) for x in specs):
+        raise SaltInvocationError("specs must be a list of dicts")
+
+    names = [spec.get("name") for spec in specs]
+    if None in names:
+        raise SaltInvocationError("Every spec needs a `name`")
+    if len(set(names)) != len(names):
+        raise SaltInvocationError("Every name can only be issued once")
+
+    concurrency = int(concurrency)
+    per_server = int(per_server)
+    batch_size = int(batch_size)
+    if concurrency < 1 or per_server < 1 or batch_size < 1:
+        raise SaltInvocationError(
+            "concurrency, per_server and batch_size must be at least 1"
+        )
+
+    # no order is placed for specs which fail locally
+    ret = {}
+    reports = preflight(specs, concurrency=concurrency)
+    for name, report in reports.items():
+        if not report["result"]:
+            ret[name] = f"Preflight failed: {'; '.join(report['problems'])}"
+    specs = [spec for spec in specs if spec["name"] not in ret]
+
+    # both limits count acme.sh processes, also the members of a dns group
+    slots = threading.BoundedSemaphore(concurrency)
+    server_locks = {
+        server: threading.BoundedSemaphore(per_server)
+        for server in {spec.get("server", "letsencrypt") for spec in specs}
+    }
+    # the members of a group only wait for the dns records together if
+    # they get their permits at once
+    batch_size = min(batch_size, concurrency, per_server)
+
+    def _run(spec):
+        # every acme.sh process gets its own copy of the credentials
+        env = _dns_env(spec.get("dns_credentials"))
+        with server_locks[spec.get("server", "letsencrypt")], slots:
+            log.debug("Issue %s", spec["name"])
+            try:
+                return _issue(env=env, **spec)
+            except (
+                SaltInvocationError,
+                CommandNotFoundError,
+                CommandExecutionError,
+            ) as err:
+                return str(err)
+            except Exception as err:
+                # one failing spec must not lose the results of the others
+                log.exception("Unable to issue %s", spec["name"])
+                return f"Unable to issue {spec['name']}: {err}"
+
+    def _job(job):
+        if len(job) == 1:
+            return [_run(job[0])]
+
+        # a dns group publishes all txt records and waits once
+        log.debug("Issue dns group %s", ", ".join(spec["name"] for spec in job))
+        with ThreadPoolExecutor(max_workers=len(job)) as group_pool:
+            return list(group_pool.map(_run, job))
+
+    jobs = []
+    groups = {}
+    for spec in specs:
+        if not dns_batch or spec.get("acme_mode") != "dns":
+            jobs.append([spec])
+            continue
+
+        if dnssleep is not None and "dnssleep" not in spec:
+            spec = dict(spec, dnssleep=dnssleep)
+        group = (
+            spec.get("user", "root"),
+            spec.get("dns_plugin"),
+            tuple(sorted((_dns_env(spec.get("dns_credentials")) or {}).items())),
+        )
+        groups.setdefault(group, []).append(spec)
+
+    for group_specs in groups.values():
+        for i in range(0, len(group_specs), batch_size):
+            jobs.append(group_specs[i : i + batch_size])
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for job, results in zip(jobs, pool.map(_job, jobs)):
+            for spec, result in zip(job, results):
+                ret[spec["name"]] = result
+
+    # keep the order of the specs
+    ret = {name: ret[name] for name in names}
+
+    failed = [
+        name
+        for name, result in ret.items()
+        if not isinstance(result, dict) or "certificate" not in result
+    ]
+    __context__["retcode"] = 1 if failed else 0
+
+    return ret
+
+
+def _writable_by(path, user):
+    """
+    Check if user can write to the existing path, from its mode bits
+    """
+
+    uid, gid = _user_ids(user)
+    if uid == 0:
+        return True
+
+    stat = os.stat(path)
+    if stat.st_uid == uid:
+        return bool(stat.st_mode & 0o200)
+    if stat.st_gid in os.getgrouplist(user, gid):
+        return bool(stat.st_mode & 0o020)
+    return bool(stat.st_mode & 0o002)
+
+
+def _port_free(port):
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        try:
+            sock.bind(("", port))
+        except OSError as err:
+            # other errors, e.g. missing permissions of the minion, are no proof
+            return err.errno != errno.EADDRINUSE
+    return True
+
+
+def _listen_port(spec):
+    """
+    Port acme.sh or the responder listens on, None if nothing listens
+    """
+
+    if spec.get("acme_mode") == "standalone":
+        return int(spec.get("http_port") or 80)
+    if spec.get("acme_mode") == "standalone-tls-alpn":
+        return int(spec.get("http_port") or 443)
+    return None
+
+
+def _issue_arguments():
+    # arguments of acme_sh.issue, without the internal ones of _run_issue
+    code = _run_issue.__code__
+    return set(code.co_varnames[: code.co_argcount]) - {"env", "on_retry"}
+
+
+def _preflight(spec, ports):
+    """
+    Problems of a spec of acme_sh.issue which can be found locally
+    """
+
+    unknown = sorted(set(spec) - _issue_arguments())
+    if unknown:
+        return [f"Unknown arguments: {', '.join(unknown)}"]
+
+    problems = []
+    user = spec.get("user", "root")
+    acme_mode = spec.get("acme_mode")
+    backend = spec.get("backend", "acme.sh")
+    responder = spec.get("responder") and acme_mode == "standalone"
+
+    try:
+        _user_ids(user)
+    except KeyError:
+        return [f"User {user} does not exist"]
+
+    possible_keylength = ["ec-256", "ec-384", "ec-521", "2048", "3072", "4096"]
+    if str(spec.get("keysize", "4096")) not in possible_keylength:
+        problems.append(f"Keysize {spec.get('keysize')} not supported")
+
+    possible_mode = ["standalone", "standalone-tls-alpn", "dns", "webroot"]
+    if acme_mode not in possible_mode:
+        problems.append(f"Acme mode {acme_mode} not supported")
+    if backend == "python" and acme_mode not in ("webroot", "standalone"):
+        problems.append(f"Acme mode {acme_mode} is not supported by the python backend")
+    elif backend not in ("acme.sh", "python"):
+        problems.append(f"Backend {backend} not supported")
+
+    acme_bin = None
+    if backend == "acme.sh":
+        try:
+            acme_bin = _acme_bin(user)
+        except CommandNotFoundError as err:
+            problems.append(str(err))
+
+    if acme_mode == "webroot":
+        webroot = spec.get("webroot")
+        # acme.sh creates .well-known/acme-challenge in the webroot
+        target = webroot
+        for sub_dir in (".well-known", "acme-challenge"):
+            if target and os.path.isdir(os.path.join(target, sub_dir)):
+                target = os.path.join(target, sub_dir)
+        if not webroot:
+            problems.append("Specify `webroot` path")
+        elif not os.path.isdir(webroot):
+            problems.append(f"Webroot {webroot} does not exist")
+        elif not _writable_by(target, user):
+            problems.append(f"{target} is not writable by {user}")
+
+    port = _listen_port(spec)
+    if port is not None:
+        if not ports.get(port, True):
+            problems.append(f"Port {port} is already in use")
+        if backend == "acme.sh" and not responder:
+            if not salt.utils.path.which_bin(["socat"]):
+                problems.append("Install socat to use standalone mode first")
+
+    if acme_mode == "dns":
+        dns_plugin = spec.get("dns_plugin")
+        dns_credentials = spec.get("dns_credentials")
+        if not dns_plugin:
+            problems.append("Specify `dns_plugin`")
+        elif acme_bin and not os.path.isfile(
+            os.path.join(os.path.dirname(acme_bin), "dnsapi", f"{dns_plugin}.sh")
+        ):
+            problems.append(f"DNS plugin {dns_plugin} is not available")
+        if not isinstance(dns_credentials, dict) or not dns_credentials:
+            problems.append("Specify `dns_credentials` as dict")
+        else:
+            empty = sorted(
+                str(key)
+                for key, value in dns_credentials.items()
+                if value in (None, "")
+            )
+            if empty:
+                problems.append(f"Empty dns credentials: {', '.join(empty)}")
+
+    return problems
+
+
+def preflight(specs, concurrency=8):
+    """
+    Check specs of acme_sh.issue locally before an order is placed
+
+    Checks the user, unknown arguments, keysize, acme mode, the acme.sh
+    installation, the write permission on the webroot, free ports and
+    socat of the standalone modes, the dns plugin and empty dns credentials.
+    Returns a dict with the name of every spec as key and a dict with
+    result and problems as value.
+
+    specs
+      list of dicts with the arguments of acme_sh.issue, see acme_sh.issue_many
+
+    concurrency
+      maximum number of specs checked at the same time
+      default: 8
+    """
+
+    if not isinstance(specs, list) or not all(isinstance(x, dict) for x in specs):
+        raise SaltInvocationError("specs must be a list of dicts")
+    if any("name" not in spec for spec in specs):
+        raise SaltInvocationError("Every spec needs a `name`")
+
+    # every port is bound once, the checks of the specs would collide
+    ports = {}
+    for spec in specs:
+        port = _listen_port(spec)
+        if port is not None and port not in ports:
+            ports[port] = _port_free(port)
+
+    with ThreadPoolExecutor(max_workers=max(1, int(concurrency))) as pool:
+        reports = list(pool.map(lambda spec: _preflight(spec, ports), specs))
+
+    ret = {}
+    for spec, problems in zip(specs, reports):
+        if problems:
+            log.debug("Preflight of %s failed: %s", spec["name"], problems)
+        ret[spec["name"]] = {"result": not problems, "problems": problems}
+
+    return ret
+
+
+def list_crt(user="root", cert_path=None):
+    """
+    List all certificates in given cert_path
+
+    user
+      run the command as a specified user
+      default: root
+
+    cert_path
+      installation dir of certs
+      default = ~/.acme.sh
+    """
+
+    acme_bin = _acme_bin(user)
+
+    cmd = [acme_bin, "--list", "--listraw"]
+
+    if cert_path:
+        cmd.extend(["--cert-home", cert_path])
+
+    list_crt_cmd = _run_acme(cmd, user, "list_crt")
+
+    if list_crt_cmd["retcode"] == 0:
+        # map output, columns are separated by | and can be empty
+        lines = list_crt_cmd["stdout"].strip().split("\n")
+        keys = lines[0].split("|")
+        ret = []
+        for line in lines[1:]:
+            if not line:
+                continue
+            values = line.split("|")
+            entry = dict(zip(keys, values))
+            ret.append(entry)
+    else:
+        ret = list_crt_cmd
+
+    return ret
+
+
+def info(name, user="root", cert_path=None):
+    """
+    Get info about a certificate
+
+    name
+      Common name of the certificate (main_domain)
+
+    user
+      run the command as a specified user
+      default: root
+
+    cert_path
+      installation dir of certs
+      default: ~/.acme.sh
+    """
+
+    if "acme_sh.info" not in __context__:
+        __context__["acme_sh.info"] = {"code": 0}
+
+    cached = _info_cache_get(name, user, cert_path)
+    if cached is not None:
+        __context__["acme_sh.info"]["code"] = cached["code"]
+        if cached["code"] == 1:
+            __context__["retcode"] = 1
+        return cached["ret"]
+
+    acme_bin = _acme_bin(user)
+
+    cmd = [acme_bin, "--info", "--domain", name]
+
+    if cert_path:
+        cmd.extend(["--cert-home", cert_path])
+    else:
+        cert_path = _default_cert_path(user, cert_path)
+
+    # check if cert_path exists
+    if not __salt__["file.directory_exists"](cert_path):
+        __context__["acme_sh.info"]["code"] = 1
+        __context__["retcode"] = 1
+        ret = f"Certificate path {cert_path} does not exist"
+        _info_cache_set(name, user, cert_path, 1, ret)
+        return ret
+    # check if cert exists
+    domain_dir = _domain_dir(cert_path, name)
+    cmd.extend(_ecc_args(domain_dir))
+    if not __salt__["file.directory_exists"](domain_dir):
+        __context__["acme_sh.info"]["code"] = 1
+        __context__["retcode"] = 1
+        ret = f"Certificate {name} does not exist"
+        _info_cache_set(name, user, cert_path, 1, ret)
+        return ret
+
+    __context__["acme_sh.info"]["code"] = 0
+
+    # read the domain conf directly, acme.sh is only needed for unknown formats
+    conf = _read_conf(os.path.join(domain_dir, f"{name}.conf"))
+    if conf is not None:
+        _info_cache_set(name, user, cert_path, 0, conf)
+        return conf
+
+    log.debug("Fallback to acme.sh --info for %s", name)
+    info_cmd = _run_acme(cmd, user, "info", domain=name)
+
+    if info_cmd["retcode"] == 0:
+        # map output to dict
+        info_dict = {}
+        lines = info_cmd["stdout"].strip().split("\n")
+        for line in lines:
+            key, value = line.split("=", 1)
+            info_dict[key] = value
+
+        ret = info_dict
+        _info_cache_set(name, user, cert_path, 0, ret)
+    else:
+        ret = info_cmd
+
+    return ret
+
+
+def info_all(user="root", cert_path=None):
+    """
+    Get info about all certificates in given cert_path
+
+    The cert_path is scanned once, every domain conf is read directly.
+    Returns a dict with the main domain as key and the info as value.
+
+    user
+      run the command as a specified user
+      default: root
+
+    cert_path
+      installation dir of certs
+      default: ~/.acme.sh
+    """
+
+    cert_path = _default_cert_path(user, cert_path)
+
+    ret = {}
+
+    try:
+        entries = list(os.scandir(cert_path))
+    except OSError as err:
+        log.debug("Unable to scan %s: %s", cert_path, err)
+        return ret
+
+    # a domain with an rsa and an ecc dir is reported with its newest conf
+    confs = {}
+    for entry in entries:
+        if not entry.is_dir():
+            continue
+
+        name = _dir_domain(entry.name)
+        mtime = _conf_mtime(f"{entry.path}/{name}.conf")
+        if mtime is not None and mtime > confs.get(name, (-1, None))[0]:
+            confs[name] = (mtime, f"{entry.path}/{name}.conf")
+
+    for name, (_, conf_path) in confs.items():
+        conf = _read_conf(conf_path)
+        if conf is None:
+            conf = info(name, user=user, cert_path=cert_path)
+            if not isinstance(conf, dict) or "retcode" in conf:
+                continue
+        else:
+            _info_cache_set(name, user, cert_path, 0, conf)
+
+        ret[name] = conf
+
+    return ret
+
+
+def renew(
+    name,
+    user="root",
+    cert_path=None,
+    force=False,
+    insecure=False,
+    backend="acme.sh",
+    retries=None,
+    retry_budget=None,
+):
+    """
+    Renew a certificate
+
+    name
+      Common name of the certificate (main_domain)
+
+    user
+      run the command as a specified user
+      default: root
+
+    cert_path
+      installation dir of certs
+      default: ~/.acme.sh
+
+    force
+      force renewing a certificate
+      default: False
+
+    insecure
+      disable ssl verification
+      default: False
+
+    backend
+      acme.sh or python
+      default: acme.sh
+
+    retries
+      retries of acme.sh after a network failure, see acme_sh.issue
+      default: 2
+
+    retry_budget
+      seconds within the retries have to start
+      default: 300
+    """
+
+    conf = _read_conf(
+        os.path.join(
+            _domain_dir(_default_cert_path(user, cert_path), name), f"{name}.conf"
+        )
+    )
+    if not conf or "Le_Domain" not in conf:
+        return _renew(
+            name, user, cert_path, force, insecure, backend, retries, retry_budget
+        )
+
+    alt = conf.get("Le_Alt", "no")
+    domains = [name] + ([] if alt == "no" else alt.split(","))
+    ticket = _ledger_admit(
+        conf.get("Le_API", "letsencrypt"), user, domains, renewal=True
+    )
+    if "deferred_until" in ticket:
+        __context__["retcode"] = 1
+        return ticket
+
+    _ORDER_STATE.sent = False
+    ret = None
+    try:
+        ret = _renew(
+            name,
+            user,
+            cert_path,
+            force,
+            insecure,
+            backend,
+            retries,
+            retry_budget,
+            on_retry=lambda: _ledger_retry(ticket, domains),
+        )
+    finally:
+        _ledger_settle(ticket, domains, ret, _ORDER_STATE.sent)
+
+    if isinstance(ret, dict) and "certificate" in ret:
+        _inventory_update(name, user, cert_path)
+
+    return ret
+
+
+def _renew(
+    name,
+    user,
+    cert_path,
+    force,
+    insecure,
+    backend,
+    retries=None,
+    retry_budget=None,
+    on_retry=None,
+):
+    if backend == "python":
+        _check_python_backend()
+        start = time.monotonic()
+        try:
+            ret = _python_renew(
+                name, user=user, cert_path=cert_path, force=force, insecure=insecure
+            )
+            __context__["retcode"] = 0
+        except (CommandExecutionError, requests.RequestException) as err:
+            __context__["retcode"] = 1
+            ret = str(err)
+        _record_python("renew", start, ret, domain=name)
+        return ret
+
+    acme_bin = _acme_bin(user)
+
+    cmd = [acme_bin, "--renew", "--domain", name]
+
+    if cert_path:
+        cmd.extend(["--cert-home", cert_path])
+    else:
+        cert_path = _default_cert_path(user, cert_path)
+    cmd.extend(_ecc_args(_domain_dir(cert_path, name)))
+
+    if force:
+        cmd.append("--force")
+
+    if insecure:
+        cmd.append("--insecure")
+
+    renew_cmd = _with_retries(
+        lambda: _run_acme(cmd, user, "renew", domain=name),
+        retries,
+        retry_budget,
+        on_retry,
+    )
+    _info_cache_invalidate(name, user, cert_path)
+
+    if renew_cmd["retcode"] == 0:
+        ret = _generate_crt_ret(name, cert_path)
+    else:
+        next_renew = re.search(r"Next renewal time is: (.*)", renew_cmd["stdout"])
+        if next_renew:
+            ret = f"Next renewal time is {next_renew.group(1)}, add force=True to renew"
+        elif renew_cmd["stdout"].find("is not an issued domain, skip") != -1:
+            ret = f"Domain {name} is not an issued domain"
+        else:
+            ret = renew_cmd
+
+    return ret
+
+
+def _parse_renew_all(output):
+    """
+    Split the output of acme.sh --renew-all into one result per domain
+
+    Returns a list of tuples with domain, status and reason.
+    """
+
+    blocks = []
+    for line in output.splitlines():
+        line = _LOG_PREFIX.sub("", _ANSI_COLOR.sub("", line)).strip()
+        match = _RENEW_ALL_DOMAIN.match(line)
+        if match:
+            blocks.append((match.group(1), []))
+        elif blocks and line:
+            blocks[-1][1].append(line)
+
+    ret = []
+    for domain, lines in blocks:
+        errors = [
+            line
+            for line in lines
+            if re.search(r"error", line, re.IGNORECASE)
+            and not line.startswith("Error renew")
+        ]
+        next_renew = None
+        for line in lines:
+            match = re.search(r"Next renewal time is:?\s*(.*)", line)
+            if match:
+                next_renew = match.group(1)
+
+        if any(line.startswith("Error renew") for line in lines):
+            ret.append((domain, "failed", errors[-1] if errors else "Error renew"))
+        elif next_renew is not None:
+            ret.append((domain, "skipped", f"Next renewal time is {next_renew}"))
+        elif any(line.startswith("Skip") for line in lines):
+            ret.append((domain, "skipped", lines[-1]))
+        elif any("Cert success" in line for line in lines):
+            ret.append((domain, "renewed", None))
+        else:
+            ret.append((domain, "failed", errors[-1] if errors else "No result"))
+
+    return ret
+
+
+def renew_offset(name, window=0):
+    """
+    Stable offset of the renewal of name on this minion in seconds
+
+    The offset is derived from a hash of the minion id and the domain,
+    so the renewals of a fleet are spread evenly over the window.
+
+    name
+      Common name of the certificate (main_domain)
+
+    window
+      hours after Le_NextRenewTime the renewals are spread over
+      default: 0
+    """
+
+    window = int(float(window) * 3600)
+    if window <= 0:
+        return 0
+
+    digest = hashlib.sha256(f"{__opts__.get('id')}:{name}".encode()).digest()
+    return int.from_bytes(digest[:8], "big") % window
+
+
+def _renew_due(info, name, window=0):
+    try:
+        next_renew = int(info["Le_NextRenewTime"])
+    except (TypeError, KeyError, ValueError):
+        return False
+
+    return int(time.time()) > next_renew + renew_offset(name, window)
+
+
+def renew_all(user="root", cert_path=None, force=False, insecure=False, renew_window=0):
+    """
+    Renew all due certificates in given cert_path with one acme.sh process
+
+    Returns a dict with the renewed domains and their cert paths,
+    the skipped and the failed domains with the reason.
+
+    user
+      run the command as a specified user
+      default: root
+
+    cert_path
+      installation dir of certs
+      default: ~/.acme.sh
+
+    force
+      force renewing all certificates
+      default: False
+
+    insecure
+      disable ssl verification
+      default: False
+
+    renew_window
+      hours the renewals are spread over, see acme_sh.renew_offset,
+      the due certificates are renewed one by one
+      default: 0
+    """
+
+    if renew_window and not force:
+        return _renew_spread(user, cert_path, insecure, renew_window)
+
+    acme_bin = _acme_bin(user)
+
+    cmd = [acme_bin, "--renew-all"]
+
+    if cert_path:
+        cmd.extend(["--cert-home", cert_path])
+    else:
+        cert_path = _default_cert_path(user, cert_path)
+
+    if force:
+        cmd.append("--force")
+
+    if insecure:
+        cmd.append("--insecure")
+
+    renew_cmd = _run_acme(cmd, user, "renew_all", redirect_stderr=True)
+
+    results = _parse_renew_all(renew_cmd["stdout"])
+
+    if not results and renew_cmd["retcode"] != 0:
+        __context__["retcode"] = 1
+        return renew_cmd
+
+    ret = {"renewed": {}, "skipped": {}, "failed": {}}
+    for domain, status, reason in results:
+        if status == "renewed":
+            ret["renewed"][domain] = _generate_crt_ret(domain, cert_path)
+            _inventory_update(domain, user, cert_path)
+        else:
+            ret[status][domain] = reason
+
+        if status != "skipped":
+            _info_cache_invalidate(domain, user, cert_path)
+
+    __context__["retcode"] = 1 if ret["failed"] else 0
+
+    return ret
+
+
+def _renew_spread(user, cert_path, insecure, renew_window):
+    """
+    Renew the certificates of cert_path which are due after their offset
+    """
+
+    ret = {"renewed": {}, "skipped": {}, "failed": {}}
+    for domain, conf in info_all(user=user, cert_path=cert_path).items():
+        if not _renew_due(conf, domain, renew_window):
+            due = int(conf.get("Le_NextRenewTime", 0)) + renew_offset(
+                domain, renew_window
+            )
+            ret["skipped"][domain] = time.strftime(
+                "Next renewal time is %Y-%m-%dT%H:%M:%SZ", time.gmtime(due)
+            )
+            continue
+
+        renewed = renew(
+            domain,
+            user=user,
+            cert_path=cert_path,
+            insecure=insecure,
+            backend=conf.get("Le_Backend", "acme.sh"),
+        )
+        if isinstance(renewed, dict) and "certificate" in renewed:
+            ret["renewed"][domain] = renewed
+        else:
+            ret["failed"][domain] = renewed
+
+    __context__["retcode"] = 1 if ret["failed"] else 0
+
+    return ret
+
+
+def version(user="root"):
+    """
+    Get version of acme.sh
+
+    user
+      run the command as a specified user
+      default: root
+    """
+
+    acme_bin = _acme_bin(user)
+
+    script_version = _script_version(acme_bin)
+    if script_version:
+        return script_version
+
+    cmd = [acme_bin, "--version"]
+
+    version_cmd = _run_acme(cmd, user, "version")
+
+    if version_cmd["retcode"] == 0:
+        ret = re.search(r"v(.*)", version_cmd["stdout"]).group(1)
+    else:
         ret = version_cmd
 
     return ret
+
+
+def _x509_details(cer_path):
+    """
+    Read a certificate in process, memoized by mtime and size of the file
+
+    Returns None if the file does not exist or is not a certificate.
+    """
+
+    try:
+        stat = os.stat(cer_path)
+    except OSError:
+        return None
+
+    cached = _X509_CACHE.get(cer_path)
+    if cached and cached[0] == (stat.st_mtime_ns, stat.st_size):
+        return cached[1]
+
+    try:
+        with open(cer_path, "rb") as cer_file:
+            crt = x509.load_pem_x509_certificate(cer_file.read())
+    except (OSError, ValueError) as err:
+        log.debug("Unable to load certificate %s: %s", cer_path, err)
+        return None
+
+    try:
+        sans = crt.extensions.get_extension_for_class(
+            x509.SubjectAlternativeName
+        ).value.get_values_for_type(x509.DNSName)
+    except x509.ExtensionNotFound:
+        sans = []
+
+    public_key = crt.public_key()
+    if isinstance(public_key, rsa.RSAPublicKey):
+        key_type = "rsa"
+    elif isinstance(public_key, ec.EllipticCurvePublicKey):
+        key_type = "ec"
+    else:
+        key_type = type(public_key).__name__
+
+    not_after = getattr(crt, "not_valid_after_utc", None)
+    if not_after is None:
+        # cryptography < 42 returns a naive datetime in UTC
+        not_after = crt.not_valid_after.replace(tzinfo=datetime.timezone.utc)
+
+    details = {
+        "not_after": int(not_after.timestamp()),
+        "sans": sorted(sans),
+        "key_type": key_type,
+        "key_size": getattr(public_key, "key_size", None),
+        "issuer": crt.issuer.rfc4514_string(),
+    }
+    _X509_CACHE[cer_path] = ((stat.st_mtime_ns, stat.st_size), details)
+
+    return details
+
+
+def cert_details(name, user="root", cert_path=None):
+    """
+    Get notAfter, subjectAltNames, key type and issuer of a certificate
+
+    The certificate is read in process, no acme.sh or openssl is started.
+
+    name
+      Common name of the certificate (main_domain)
+
+    user
+      run the command as a specified user
+      default: root
+
+    cert_path
+      installation dir of certs
+      default: ~/.acme.sh
+    """
+
+    if not HAS_CRYPTOGRAPHY:
+        raise CommandExecutionError("The python cryptography library is required")
+
+    cert_path = _default_cert_path(user, cert_path)
+
+    details = _x509_details(os.path.join(_domain_dir(cert_path, name), f"{name}.cer"))
+
+    if details is None:
+        __context__["retcode"] = 1
+        return f"Certificate {name} does not exist"
+
+    return details
+
+
+def check_drift(name, aliases=None, keysize="4096", user="root", cert_path=None):
+    """
+    Compare a certificate on disk with the requested names and keysize
+
+    Returns a list with the differences, an empty list if the certificate
+    matches or cannot be checked.
+
+    name
+      Common name of the certificate (main_domain)
+
+    aliases
+      comma seperated, subjectAltNames
+
+    keysize
+      requested key, see acme_sh.issue
+      default = 4096
+
+    user
+      run the command as a specified user
+      default: root
+
+    cert_path
+      installation dir of certs
+      default: ~/.acme.sh
+    """
+
+    if not HAS_CRYPTOGRAPHY:
+        log.debug("cryptography is not available, skip drift check of %s", name)
+        return []
+
+    cert_path = _default_cert_path(user, cert_path)
+
+    # the dir of the requested key type, a reissue lands there
+    details = _x509_details(
+        os.path.join(_domain_dir(cert_path, name, keysize), f"{name}.cer")
+    )
+    if details is None:
+        details = _x509_details(
+            os.path.join(_domain_dir(cert_path, name), f"{name}.cer")
+        )
+
+    if details is None:
+        return []
+
+    if isinstance(aliases, str):
+        aliases = [alias for alias in aliases.split(",") if alias]
+
+    ret = []
+
+    # dns names are case insensitive, CAs return them lowercase
+    def _normalize(names):
+        return sorted({x.rstrip(".").lower() for x in names})
+
+    wanted = _normalize([name, *(aliases or [])])
+    sans = _normalize(details["sans"])
+    if wanted != sans:
+        ret.append(f"subjectAltNames {sans} != {wanted}")
+
+    keysize = str(keysize)
+    if keysize.startswith("ec-"):
+        wanted_key = ("ec", int(keysize[3:]))
+    else:
+        wanted_key = ("rsa", int(keysize))
+    if wanted_key != (details["key_type"], details["key_size"]):
+        ret.append(
+            f"key {details['key_type']}-{details['key_size']} != "
+            f"{wanted_key[0]}-{wanted_key[1]}"
+        )
+
+    return ret
+
+
+def cert_hashes(name, user="root", cert_path=None):
+    """
+    Get the sha256 of the certificate files of name
+
+    Missing files are left out.
+
+    name
+      Common name of the certificate (main_domain)
+
+    user
+      owner of the certificate
+      default: root
+
+    cert_path
+      installation dir of certs
+      default: ~/.acme.sh
+    """
+
+    domain_path = _domain_dir(_default_cert_path(user, cert_path), name)
+
+    ret = {}
+    for file_name in _CERT_FILES:
+        file_name = file_name.format(name=name)
+        try:
+            ret[file_name] = _sha256(os.path.join(domain_path, file_name))
+        except FileNotFoundError:
+            continue
+
+    return ret
+
+
+def cert_files(name, user="root", cert_path=None):
+    """
+    Get the content of the certificate files of name
+
+    name
+      Common name of the certificate (main_domain)
+
+    user
+      owner of the certificate
+      default: root
+
+    cert_path
+      installation dir of certs
+      default: ~/.acme.sh
+    """
+
+    domain_path = _domain_dir(_default_cert_path(user, cert_path), name)
+
+    ret = {}
+    for file_name in _CERT_FILES:
+        file_name = file_name.format(name=name)
+        try:
+            with open(os.path.join(domain_path, file_name), encoding="utf-8") as crt:
+                ret[file_name] = crt.read()
+        except FileNotFoundError:
+            continue
+
+    if f"{name}.cer" not in ret:
+        __context__["retcode"] = 1
+        return f"Certificate {name} does not exist"
+
+    return ret
+
+
+def put_cert_files(name, files, user="root", cert_path=None):
+    """
+    Write certificate files of name, e.g. from acme_sh.cert_files
+
+    Only files with a different content are written, every file is
+    replaced atomically. Returns the written files.
+
+    name
+      Common name of the certificate (main_domain)
+
+    files
+      dict with the file name as key and the content as value
+
+    user
+      owner of the certificate
+      default: root
+
+    cert_path
+      installation dir of certs
+      default: ~/.acme.sh
+    """
+
+    allowed = {file_name.format(name=name) for file_name in _CERT_FILES}
+    if not isinstance(files, dict) or not set(files) <= allowed:
+        raise SaltInvocationError(
+            f"files must be a dict with the keys {', '.join(sorted(allowed))}"
+        )
+
+    cert_path = _default_cert_path(user, cert_path)
+    domain_path = _domain_dir(cert_path, name)
+    uid, gid = _user_ids(user)
+    os.makedirs(domain_path, mode=0o700, exist_ok=True)
+    os.chown(domain_path, uid, gid)
+
+    hashes = cert_hashes(name, user=user, cert_path=cert_path)
+    ret = []
+    for file_name, content in sorted(files.items()):
+        if hashlib.sha256(content.encode()).hexdigest() == hashes.get(file_name):
+            continue
+        mode = 0o600 if file_name.endswith(".key") else 0o644
+        _atomic_write(os.path.join(domain_path, file_name), content, mode, uid, gid)
+        ret.append(file_name)
+
+    if ret:
+        _info_cache_invalidate(name, user, cert_path)
+        _inventory_update(name, user, cert_path)
+
+    return ret
+
+
+def deploy(
+    name,
+    user="root",
+    cert_path=None,
+    cert=None,
+    key=None,
+    fullchain=None,
+    ca=None,
+    owner=None,
+    group=None,
+    mode="0644",
+    key_mode="0600",
+    test=False,
+):
+    """
+    Install the files of a certificate to target paths
+
+    Only files with a different sha256 are written, every file is
+    replaced atomically. The mode and owner of unchanged files are
+    corrected. Returns a dict with the written or corrected target paths
+    and the sha256 of their content.
+
+    name
+      Common name of the certificate (main_domain)
+
+    user
+      owner of the certificate
+      default: root
+
+    cert_path
+      installation dir of certs
+      default: ~/.acme.sh
+
+    cert
+      target path of the certificate
+
+    key
+      target path of the private key
+
+    fullchain
+      target path of the certificate with the intermediate certificates
+
+    ca
+      target path of the intermediate certificates
+
+    owner
+      owner of the written files
+      default: user of the minion
+
+    group
+      group of the written files
+      default: group of the minion
+
+    mode
+      mode of the written certificate files
+      default: 0644
+
+    key_mode
+      mode of the written private key
+      default: 0600
+
+    test
+      only return the files which would be written
+      default: False
+    """
+
+    targets = {
+        f"{name}.cer": cert,
+        f"{name}.key": key,
+        "fullchain.cer": fullchain,
+        "ca.cer": ca,
+    }
+    if not any(targets.values()):
+        raise SaltInvocationError("Specify at least one of cert, key, fullchain or ca")
+
+    domain_path = _domain_dir(_default_cert_path(user, cert_path), name)
+    try:
+        uid = pwd.getpwnam(owner).pw_uid if owner else -1
+    except KeyError:
+        __context__["retcode"] = 1
+        return f"Owner {owner} does not exist"
+    try:
+        gid = grp.getgrnam(group).gr_gid if group else -1
+    except KeyError:
+        __context__["retcode"] = 1
+        return f"Group {group} does not exist"
+
+    ret = {}
+    for source, target in targets.items():
+        if not target:
+            continue
+
+        try:
+            with open(os.path.join(domain_path, source), "rb") as source_file:
+                data = source_file.read()
+        except FileNotFoundError:
+            __context__["retcode"] = 1
+            return f"{source} of {name} does not exist"
+
+        if not os.path.isdir(os.path.dirname(target) or "."):
+            __context__["retcode"] = 1
+            return f"Directory of {target} does not exist"
+
+        new_hash = hashlib.sha256(data).hexdigest()
+        file_mode = int(str(key_mode if source.endswith(".key") else mode), 8)
+        try:
+            if _sha256(target) == new_hash:
+                stat = os.stat(target)
+                if (
+                    stat.st_mode & 0o7777 == file_mode
+                    and uid in (-1, stat.st_uid)
+                    and gid in (-1, stat.st_gid)
+                ):
+                    continue
+
+                ret[target] = new_hash
+                if not test:
+                    os.chmod(target, file_mode)
+                    os.chown(target, uid, gid)
+                continue
+        except FileNotFoundError:
+            pass
+        except OSError as err:
+            __context__["retcode"] = 1
+            return f"Unable to deploy {target}: {err}"
+
+        ret[target] = new_hash
+        if test:
+            continue
+
+        try:
+            _atomic_write(target, data, file_mode, uid, gid)
+        except OSError as err:
+            __context__["retcode"] = 1
+            return f"Unable to deploy {target}: {err}"
+
+    return ret
+
+
+def _inventory_details(name, conf, cer_path):
+    """
+    Names, expiry, issuer and key type of a certificate
+
+    Without cryptography only the domain conf is used.
+    """
+
+    names = {name}
+    if HAS_CRYPTOGRAPHY:
+        details = _x509_details(cer_path)
+        if details:
+            return (
+                names | set(details["sans"]),
+                details["not_after"],
+                details["issuer"],
+                details["key_type"],
+            )
+
+    alt = conf.get("Le_Alt", "no")
+    if alt != "no":
+        names.update(alias for alias in alt.split(",") if alias)
+    keylength = conf.get("Le_Keylength", "")
+    key_type = "ec" if keylength.startswith("ec-") else "rsa" if keylength else None
+    return names, None, None, key_type
+
+
+def _inventory_index(conn, dir_name, user, cert_path, conf_mtime=None):
+    """
+    Write the entry of one domain dir, remove it if the domain is gone
+    """
+
+    name = _dir_domain(dir_name)
+    path = os.path.join(cert_path, dir_name)
+    conf_path = os.path.join(path, f"{name}.conf")
+    conf = _read_conf(conf_path)
+
+    conn.execute("DELETE FROM names WHERE path = ?", (path,))
+    if not conf or "Le_Domain" not in conf:
+        conn.execute("DELETE FROM certs WHERE path = ?", (path,))
+        conn.execute("DELETE FROM details WHERE path = ?", (path,))
+        return
+
+    names, not_after, issuer, key_type = _inventory_details(
+        name, conf, os.path.join(path, f"{name}.cer")
+    )
+    next_renew = conf.get("Le_NextRenewTime", "")
+    conn.execute(
+        "INSERT OR REPLACE INTO certs (path, name, user, cert_path, keylength, "
+        "not_after, next_renew, conf_mtime) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+        (
+            path,
+            name,
+            user,
+            cert_path,
+            conf.get("Le_Keylength"),
+            not_after,
+            int(next_renew) if next_renew.isdigit() else None,
+            conf_mtime if conf_mtime is not None else _conf_mtime(conf_path),
+        ),
+    )
+    conn.executemany(
+        "INSERT INTO names (name, path) VALUES (?, ?)",
+        [(x.lower(), path) for x in names],
+    )
+    conn.execute(
+        "INSERT OR REPLACE INTO details (path, issuer, key_type) VALUES (?, ?, ?)",
+        (path, issuer, key_type),
+    )
+
+
+def _inventory_update(name, user, cert_path):
+    """
+    Update the inventory after a certificate of name changed
+    """
+
+    cert_path = _default_cert_path(user, cert_path)
+    try:
+        with _db("inventory") as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            for dir_name in (name, f"{name}_ecc"):
+                _inventory_index(conn, dir_name, user, cert_path)
+            conn.execute("COMMIT")
+    except sqlite3.Error as err:
+        log.warning("Unable to update the inventory of %s: %s", name, err)
+
+
+def index_certs(user="root", cert_path=None):
+    """
+    Add all certificates of a cert_path to the inventory of acme_sh.lookup
+
+    Only domains with a changed domain conf are read again, removed
+    domains are dropped. acme_sh.issue and acme_sh.renew update the
+    inventory themselves. Returns the number of indexed and updated certificates.
+
+    user
+      owner of the certificates
+      default: root
+
+    cert_path
+      installation dir of certs
+      default: ~/.acme.sh
+    """
+
+    cert_path = _default_cert_path(user, cert_path)
+
+    try:
+        entries = [
+            entry.name
+            for entry in os.scandir(cert_path)
+            if entry.is_dir()
+            and os.path.isfile(f"{entry.path}/{_dir_domain(entry.name)}.conf")
+        ]
+    except OSError as err:
+        log.debug("Unable to scan %s: %s", cert_path, err)
+        entries = []
+
+    updated = 0
+    with _db("inventory") as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        # entries without details are read again
+        indexed = dict(
+            conn.execute(
+                "SELECT certs.path, CASE WHEN details.path IS NULL THEN NULL "
+                "ELSE certs.conf_mtime END FROM certs "
+                "LEFT JOIN details ON details.path = certs.path "
+                "WHERE certs.cert_path = ?",
+                (cert_path,),
+            ).fetchall()
+        )
+        indexed = {os.path.basename(path): mtime for path, mtime in indexed.items()}
+        for dir_name in set(indexed) - set(entries):
+            _inventory_index(conn, dir_name, user, cert_path)
+        for dir_name in entries:
+            conf_mtime = _conf_mtime(
+                os.path.join(cert_path, dir_name, f"{_dir_domain(dir_name)}.conf")
+            )
+            if dir_name in indexed and indexed[dir_name] == conf_mtime:
+                continue
+            _inventory_index(conn, dir_name, user, cert_path, conf_mtime)
+            updated += 1
+        conn.execute("COMMIT")
+
+    return {"indexed": len(entries), "updated": updated}
+
+
+def inventory(user="root", cert_path=None):
+    """
+    Compact inventory of all certificates of the minion, e.g. for the salt mine
+
+    Returns a list with domain, names, expiry (epoch), issuer and key type
+    of every certificate in the inventory of acme_sh.lookup. All known
+    cert paths and the cert_path of user are refreshed first, only
+    changed domain confs are read. No acme.sh process is started.
+
+    user
+      owner of an additional cert_path to add to the inventory
+      default: root
+
+    cert_path
+      additional cert path
+      default: ~/.acme.sh
+
+    .. code-block:: yaml
+
+        mine_functions:
+          acme_sh.inventory: []
+    """
+
+    with _db("inventory") as conn:
+        known = set(
+            conn.execute("SELECT DISTINCT user, cert_path FROM certs").fetchall()
+        )
+    known.add((user, _default_cert_path(user, cert_path)))
+
+    for path_user, path in sorted(known):
+        index_certs(user=path_user, cert_path=path)
+
+    with _db("inventory") as conn:
+        rows = conn.execute(
+            "SELECT certs.path, certs.name, certs.not_after, details.issuer, "
+            "details.key_type FROM certs LEFT JOIN details ON details.path = certs.path "
+            "ORDER BY certs.name"
+        ).fetchall()
+        ret = []
+        for path, name, not_after, issuer, key_type in rows:
+            names = [
+                x
+                for (x,) in conn.execute(
+                    "SELECT name FROM names WHERE path = ? ORDER BY name", (path,)
+                )
+            ]
+            ret.append(
+                {
+                    "domain": name,
+                    "names": names,
+                    "expires": not_after,
+                    "issuer": issuer,
+                    "key_type": key_type,
+                    "path": path,
+                }
+            )
+
+    return ret
+
+
+def lookup(domain):
+    """
+    Find the certificates which cover domain
+
+    Exact and subjectAltName matches are returned before wildcard
+    matches, the certificate with the latest expiry first. Every match
+    is an indexed query, see acme_sh.index_certs to fill the inventory.
+
+    domain
+      hostname to look up, e.g. api.foo.example.com
+    """
+
+    domain = domain.lower().rstrip(".")
+    candidates = [domain]
+    if "." in domain:
+        # a wildcard covers exactly one label
+        candidates.append("*." + domain.split(".", 1)[1])
+
+    ret = []
+    found = set()
+    with _db("inventory") as conn:
+        for wildcard, candidate in enumerate(candidates):
+            rows = conn.execute(
+                "SELECT certs.path, certs.name, certs.user, certs.cert_path, "
+                "certs.keylength, certs.not_after, certs.next_renew "
+                "FROM names JOIN certs ON certs.path = names.path "
+                "WHERE names.name = ? ORDER BY certs.not_after DESC",
+                (candidate,),
+            ).fetchall()
+            for path, name, user, cert_path, keylength, not_after, next_renew in rows:
+                if path in found:
+                    continue
+                found.add(path)
+                names = [
+                    x
+                    for (x,) in conn.execute(
+                        "SELECT name FROM names WHERE path = ? ORDER BY name", (path,)
+                    )
+                ]
+                ret.append(
+                    dict(
+                        _generate_crt_ret(name, cert_path),
+                        name=name,
+                        names=names,
+                        match=(
+                            "wildcard"
+                            if wildcard
+                            else "exact" if name == domain else "san"
+                        ),
+                        user=user,
+                        cert_path=cert_path,
+                        keylength=keylength,
+                        not_after=not_after,
+                        next_renew=next_renew,
+                    )
+                )
+
+    return ret
+
+
+def _b64(data):
+    if isinstance(data, str):
+        data = data.encode()
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode()
+
+
+def _directory_url(server):
+    return _ACME_SERVERS.get(server, server)
+
+
+def _user_ids(user):
+    pw_user = pwd.getpwnam(user)
+    return pw_user.pw_uid, pw_user.pw_gid
+
+
+def _atomic_write(path, data, mode=0o644, uid=-1, gid=-1):
+    """
+    Write data to a temporary file next to path and move it into place
+    """
+
+    if isinstance(data, str):
+        data = data.encode()
+
+    fd, tmp_path = tempfile.mkstemp(
+        dir=os.path.dirname(path), prefix=f".{os.path.basename(path)}."
+    )
+    try:
+        with os.fdopen(fd, "wb") as tmp_file:
+            tmp_file.write(data)
+            tmp_file.flush()
+            os.fsync(tmp_file.fileno())
+        os.chmod(tmp_path, mode)
+        if uid != -1 or gid != -1:
+            os.chown(tmp_path, uid, gid)
+        os.replace(tmp_path, path)
+    except BaseException:
+        with contextlib.suppress(OSError):
+            os.remove(tmp_path)
+        raise
+
+
+def _generate_key(keysize):
+    """
+    Generate a private key in PEM format, keysize as in acme_sh.issue
+    """
+
+    keysize = str(keysize)
+    curves = {
+        "ec-256": ec.SECP256R1,
+        "ec-384": ec.SECP384R1,
+        "ec-521": ec.SECP521R1,
+    }
+
+    if keysize in curves:
+        key = ec.generate_private_key(curves[keysize]())
+    else:
+        key = rsa.generate_private_key(public_exponent=65537, key_size=int(keysize))
+
+    return key.private_bytes(
+        serialization.Encoding.PEM,
+        serialization.PrivateFormat.PKCS8,
+        serialization.NoEncryption(),
+    )
+
+
+def _keypool_dir(user, keysize):
+    return os.path.join(_home_dir(user), ".acme.sh", "keypool", str(keysize))
+
+
+def _keypool_size(pool_dir):
+    try:
+        return len([x for x in os.listdir(pool_dir) if x.endswith(".key")])
+    except FileNotFoundError:
+        return 0
+
+
+def _keypool_take(user, keysize):
+    """
+    Take a private key out of the pool, None if the pool is empty
+    """
+
+    pool_dir = _keypool_dir(user, keysize)
+    try:
+        keys = sorted(x for x in os.listdir(pool_dir) if x.endswith(".key"))
+    except FileNotFoundError:
+        return None
+
+    for key in keys:
+        # the rename claims the key, concurrent issues never get the same one
+        claimed = os.path.join(
+            pool_dir, f".{key}.{os.getpid()}.{threading.get_ident()}"
+        )
+        try:
+            os.rename(os.path.join(pool_dir, key), claimed)
+        except FileNotFoundError:
+            continue
+        with open(claimed, "rb") as key_file:
+            key_pem = key_file.read()
+        os.remove(claimed)
+        log.debug("Took %s key %s from the pool of %s", keysize, key, user)
+        return key_pem
+
+    return None
+
+
+def _keypool_fill(user, keysize, depth):
+    pool_dir = _keypool_dir(user, keysize)
+    uid, gid = _user_ids(user)
+
+    for path in (os.path.dirname(pool_dir), pool_dir):
+        os.makedirs(path, mode=0o700, exist_ok=True)
+        os.chown(path, uid, gid)
+
+    added = 0
+    while _keypool_size(pool_dir) < depth:
+        key_path = os.path.join(pool_dir, f"{time.time_ns()}.key")
+        _atomic_write(key_path, _generate_key(keysize), 0o600, uid, gid)
+        added += 1
+
+    return added
+
+
+def _pooled_key(user, keysize, keypool=0):
+    """
+    Return a new private key, from the pool of user if keypool is set
+
+    The pool is not refilled here, see acme_sh.keypool_fill.
+    """
+
+    if not keypool:
+        return _generate_key(keysize)
+
+    key_pem = _keypool_take(user, keysize)
+    if key_pem is None:
+        log.debug("The %s key pool of %s is empty", keysize, user)
+        key_pem = _generate_key(keysize)
+
+    return key_pem
+
+
+def _domain_csr(name, domains, key_pem):
+    domain_key = serialization.load_pem_private_key(key_pem, None)
+    return (
+        x509.CertificateSigningRequestBuilder()
+        .subject_name(x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, name)]))
+        .add_extension(
+            x509.SubjectAlternativeName([x509.DNSName(d) for d in domains]),
+            critical=False,
+        )
+        .sign(domain_key, hashes.SHA256())
+    )
+
+
+def _keypool_csr(name, aliases, keysize, user, cert_path, keypool):
+    """
+    Return a csr file of a pooled key and the key, for acme.sh --signcsr
+
+    acme.sh only signs a csr of a domain without a key, the key is
+    installed with _keypool_install after the certificate was issued.
+    Returns None, None if acme.sh has to keep or create the key itself:
+    the domain dir already has a key or cryptography is not available.
+    """
+
+    if not HAS_CRYPTOGRAPHY:
+        log.warning("The key pool requires the cryptography library")
+        return None, None
+
+    domain_dir = _domain_dir(cert_path, name, keysize)
+    if os.path.exists(os.path.join(domain_dir, f"{name}.key")):
+        return None, None
+
+    key_pem = _pooled_key(user, keysize, keypool)
+    domains = [name] + [alias for alias in (aliases or "").split(",") if alias]
+    csr = _domain_csr(name, domains, key_pem)
+    fd, csr_file = tempfile.mkstemp(prefix=f"acme_sh-{name}.", suffix=".csr")
+    with os.fdopen(fd, "wb") as tmp_file:
+        tmp_file.write(csr.public_bytes(serialization.Encoding.PEM))
+    os.chown(csr_file, *_user_ids(user))
+
+    return csr_file, key_pem
+
+
+def _keypool_install(name, keysize, user, cert_path, key_pem):
+    """
+    Write the pooled key of a certificate signed with --signcsr
+    """
+
+    domain_dir = _domain_dir(cert_path, name, keysize)
+    uid, gid = _user_ids(user)
+    _atomic_write(os.path.join(domain_dir, f"{name}.key"), key_pem, 0o600, uid, gid)
+
+
+def keypool_fill(keysize="4096", depth=4, user="root"):
+    """
+    Pre-generate private keys for acme_sh.issue with keypool
+
+    The keys are stored in ~/.acme.sh/keypool/<keysize>,
+    readable by user only. The keys are generated before the function
+    returns, run it e.g. from the schedule of the minion.
+
+    keysize
+      key type, see acme_sh.issue
+      default: 4096
+
+    depth
+      number of keys to keep in the pool
+      default: 4
+
+    user
+      owner of the pool
+      default: root
+    """
+
+    possible_keylength = ["ec-256", "ec-384", "ec-521", "2048", "3072", "4096"]
+    if str(keysize) not in possible_keylength:
+        raise SaltInvocationError(f"Keysize {keysize} not supported")
+
+    if not HAS_CRYPTOGRAPHY:
+        __context__["retcode"] = 1
+        return "The key pool requires the cryptography library"
+
+    depth = int(depth)
+    added = _keypool_fill(user, str(keysize), depth)
+    return {"keysize": str(keysize), "added": added, "size": depth}
+
+
+class _AcmeClient:
+    """
+    ACME (RFC 8555) client of the python backend
+
+    One client is kept per directory and account key for the lifetime of
+    the process. It reuses the http connections, the directory and the
+    nonces of previous responses.
+    """
+
+    def __init__(self, directory_url, account_key, insecure=False):
+        self.directory_url = directory_url
+        self.key = account_key
+        self.kid = None
+        self._directory = None
+        self._nonces = deque()
+        self._lock = threading.Lock()
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=16)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.session.verify = not insecure
+        self.session.headers["User-Agent"] = "salt-acme_sh"
+
+        if isinstance(account_key, rsa.RSAPrivateKey):
+            numbers = account_key.public_key().public_numbers()
+            self.alg = "RS256"
+            self.jwk = {
+                "e": _b64(numbers.e.to_bytes((numbers.e.bit_length() + 7) // 8, "big")),
+                "kty": "RSA",
+                "n": _b64(numbers.n.to_bytes((numbers.n.bit_length() + 7) // 8, "big")),
+            }
+        else:
+            curve = account_key.curve
+            size = (curve.key_size + 7) // 8
+            numbers = account_key.public_key().public_numbers()
+            self.alg, self._hash, crv = {
+                256: ("ES256", hashes.SHA256, "P-256"),
+                384: ("ES384", hashes.SHA384, "P-384"),
+                521: ("ES512", hashes.SHA512, "P-521"),
+            }[curve.key_size]
+            self._size = size
+            self.jwk = {
+                "crv": crv,
+                "kty": "EC",
+                "x": _b64(numbers.x.to_bytes(size, "big")),
+                "y": _b64(numbers.y.to_bytes(size, "big")),
+            }
+
+        self.thumbprint = _b64(
+            hashlib.sha256(
+                json.dumps(self.jwk, sort_keys=True, separators=(",", ":")).encode()
+            ).digest()
+        )
+
+    @property
+    def directory(self):
+        if self._directory is None:
+            response = self.session.get(self.directory_url, timeout=30)
+            response.raise_for_status()
+            self._directory = response.json()
+        return self._directory
+
+    def _sign(self, data):
+        if self.alg == "RS256":
+            return self.key.sign(data, padding.PKCS1v15(), hashes.SHA256())
+
+        r, s = decode_dss_signature(self.key.sign(data, ec.ECDSA(self._hash())))
+        return r.to_bytes(self._size, "big") + s.to_bytes(self._size, "big")
+
+    def _nonce(self):
+        with self._lock:
+            if self._nonces:
+                return self._nonces.popleft()
+
+        response = self.session.head(self.directory["newNonce"], timeout=30)
+        return response.headers["Replay-Nonce"]
+
+    def _keep_nonce(self, response):
+        nonce = response.headers.get("Replay-Nonce")
+        if nonce:
+            with self._lock:
+                self._nonces.append(nonce)
+
+    def post(self, url, payload=None, use_jwk=False):
+        """
+        Send a signed request, payload None is a POST-as-GET
+        """
+
+        for attempt in range(3):
+            protected = {"alg": self.alg, "nonce": self._nonce(), "url": url}
+            if use_jwk:
+                protected["jwk"] = self.jwk
+            else:
+                protected["kid"] = self.kid
+
+            protected = _b64(json.dumps(protected))
+            payload_b64 = "" if payload is None else _b64(json.dumps(payload))
+            body = {
+                "protected": protected,
+                "payload": payload_b64,
+                "signature": _b64(self._sign(f"{protected}.{payload_b64}".encode())),
+            }
+
+            try:
+                response = self.session.post(
+                    url,
+                    data=json.dumps(body),
+                    headers={"Content-Type": "application/jose+json"},
+                    timeout=60,
+                )
+            except (requests.ConnectionError, requests.Timeout) as err:
+                if attempt == 2:
+                    raise
+                delay = _backoff_delay(attempt)
+                log.debug("Retry ACME request to %s in %.1fs: %s", url, delay, err)
+                time.sleep(delay)
+                continue
+            self._keep_nonce(response)
+
+            if response.status_code < 400:
+                return response
+
+            if response.status_code in _RETRY_STATUS and attempt < 2:
+                delay = _backoff_delay(attempt)
+                log.debug(
+                    "Retry ACME request to %s in %.1fs: %s",
+                    url,
+                    delay,
+                    response.status_code,
+                )
+                time.sleep(delay)
+                continue
+
+            problem = {}
+            if response.headers.get("Content-Type", "").startswith(
+                "application/problem+json"
+            ):
+                problem = response.json()
+            if problem.get("type") != "urn:ietf:params:acme:error:badNonce":
+                raise CommandExecutionError(
+                    f"ACME request to {url} failed: "
+                    f"{problem.get('detail', response.status_code)}",
+                    info=problem,
+                )
+            log.debug("Retry ACME request to %s with a new nonce", url)
+
+        raise CommandExecutionError(f"ACME request to {url} failed: badNonce")
+
+    def account(self, email=None):
+        """
+        Look up the account of the key, register a new one if needed
+        """
+
+        if self.kid:
+            return self.kid
+
+        try:
+            response = self.post(
+                self.directory["newAccount"],
+                {"onlyReturnExisting": True},
+                use_jwk=True,
+            )
+        except CommandExecutionError as err:
+            if "accountDoesNotExist" not in str(err.info):
+                raise
+            payload = {"termsOfServiceAgreed": True}
+            if email:
+                payload["contact"] = [f"mailto:{email}"]
+            response = self.post(self.directory["newAccount"], payload, use_jwk=True)
+
+        self.kid = response.headers["Location"]
+        return self.kid
+
+    def poll(self, url, pending=("pending", "processing", "ready"), timeout=300):
+        deadline = time.time() + timeout
+        while True:
+            response = self.post(url)
+            ret = response.json()
+            if ret["status"] not in pending or time.time() > deadline:
+                return ret
+            time.sleep(min(int(response.headers.get("Retry-After", 2)), 10))
+
+
+def _acme_client(user, server, insecure=False):
+    """
+    Return the shared client for the acme.sh account key of user at server
+
+    The account key of acme.sh is used, so both backends use the same
+    account. A new P-256 key is created if acme.sh has none yet.
+    """
+
+    directory_url = _directory_url(server)
+
+    # same location as acme.sh: ca/<host>/<path>/account.key
+    host_path = directory_url.split("://", 1)[-1]
+    host, _, path = host_path.partition("/")
+    ca_dir = os.path.join(_home_dir(user), ".acme.sh", "ca", host.split(":")[0], path)
+    key_path = os.path.join(ca_dir, "account.key")
+
+    with _ACME_CLIENTS_LOCK:
+        client = _ACME_CLIENTS.get((directory_url, key_path, insecure))
+        if client:
+            return client
+
+        uid, gid = _user_ids(user)
+        if not os.path.isfile(key_path):
+            os.makedirs(ca_dir, mode=0o700, exist_ok=True)
+            os.chown(ca_dir, uid, gid)
+            _atomic_write(key_path, _generate_key("ec-256"), 0o600, uid, gid)
+
+        with open(key_path, "rb") as key_file:
+            account_key = serialization.load_pem_private_key(key_file.read(), None)
+
+        client = _AcmeClient(directory_url, account_key, insecure)
+        _ACME_CLIENTS[(directory_url, key_path, insecure)] = client
+
+    return client
+
+
+def _check_python_backend():
+    if not HAS_CRYPTOGRAPHY or not HAS_REQUESTS:
+        raise CommandExecutionError(
+            "The python backend requires the cryptography and requests libraries"
+        )
+
+
+def _account_email(user):
+    conf = _read_conf(os.path.join(_home_dir(user), ".acme.sh", "account.conf"))
+    return (conf or {}).get("ACCOUNT_EMAIL")
+
+
+def _quote_conf(value):
+    value = str(value)
+    if "'" in value or "\n" in value:
+        value = (
+            _B64CONF_START + base64.b64encode(value.encode()).decode() + _B64CONF_END
+        )
+    return f"'{value}'"
+
+
+def _order_time(value):
+    """
+    RFC 3339 timestamp of valid_to or valid_from for a new order
+
+    Accepts the formats of acme.sh: +<n>d and +<n>h relative to now, or a
+    timestamp like 2026-12-01T00:00:00Z.
+    """
+
+    match = re.fullmatch(r"\+(\d+)([dh])", str(value).strip())
+    if match:
+        amount = int(match.group(1))
+        delta = (
+            datetime.timedelta(days=amount)
+            if match.group(2) == "d"
+            else datetime.timedelta(hours=amount)
+        )
+        when = datetime.datetime.now(datetime.timezone.utc) + delta
+        return when.strftime("%Y-%m-%dT%H:%M:%SZ")
+
+    try:
+        when = datetime.datetime.fromisoformat(str(value).replace("Z", "+00:00"))
+    except ValueError:
+        raise SaltInvocationError(
+            f"{value} is neither +<n>d, +<n>h nor an RFC 3339 timestamp"
+        ) from None
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=datetime.timezone.utc)
+    return when.astimezone(datetime.timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+def _python_issue(
+    name,
+    acme_mode,
+    aliases=None,
+    server="letsencrypt",
+    keysize="4096",
+    webroot=None,
+    http_port=None,
+    user="root",
+    cert_path=None,
+    force=False,
+    valid_to=None,
+    valid_from=None,
+    insecure=False,
+    keypool=0,
+):
+    """
+    Obtain a certificate with the python backend
+
+    Writes the same files as acme.sh into <cert_path>/<name>, or
+    <cert_path>/<name>_ecc for ecc keys.
+    """
+
+    if acme_mode not in ("webroot", "standalone"):
+        raise SaltInvocationError(
+            f"Acme mode {acme_mode} is not supported by the python backend"
+        )
+
+    possible_keylength = ["ec-256", "ec-384", "ec-521", "2048", "3072", "4096"]
+    if str(keysize) not in possible_keylength:
+        raise SaltInvocationError(f"Keysize {keysize} not supported")
+
+    if acme_mode == "webroot" and not webroot:
+        raise SaltInvocationError("Specify `webroot` path")
+
+    # the order must not be placed with a validity the ca cannot parse
+    if valid_to:
+        valid_to = _order_time(valid_to)
+    if valid_from:
+        valid_from = _order_time(valid_from)
+
+    cert_path = _default_cert_path(user, cert_path)
+    domain_path = _domain_dir(cert_path, name, keysize)
+    conf_path = os.path.join(domain_path, f"{name}.conf")
+    uid, gid = _user_ids(user)
+
+    conf = _read_conf(conf_path) or {}
+    if (
+        not force
+        and conf.get("Le_NextRenewTime", "").isdigit()
+        and int(time.time()) < int(conf["Le_NextRenewTime"])
+    ):
+        return f"Certificate in {domain_path} is valid, re run with `force=True`"
+
+    domains = [name] + [alias for alias in (aliases or "").split(",") if alias]
+
+    client = _acme_client(user, server, insecure)
+    client.account(_account_email(user))
+
+    new_order = {"identifiers": [{"type": "dns", "value": d} for d in domains]}
+    if valid_from:
+        new_order["notBefore"] = valid_from
+    if valid_to:
+        new_order["notAfter"] = valid_to
+    _ORDER_STATE.sent = True
+    response = client.post(client.directory["newOrder"], new_order)
+    order_url = response.headers["Location"]
+    order = response.json()
+
+    # publish and answer all http-01 challenges
+    challenges = []
+    for authz_url in order["authorizations"]:
+        authz = client.post(authz_url).json()
+        if authz["status"] == "valid":
+            continue
+        challenge = next(
+            (c for c in authz["challenges"] if c["type"] == "http-01"), None
+        )
+        if challenge is None:
+            raise CommandExecutionError(
+                f"No http-01 challenge for {authz['identifier']['value']}"
+            )
+        challenges.append((authz_url, challenge))
+
+    with contextlib.ExitStack() as stack:
+        if acme_mode == "standalone" and challenges:
+            responder = stack.enter_context(_challenge_responder(int(http_port or 80)))
+
+        for authz_url, challenge in challenges:
+            token = challenge["token"]
+            key_authorization = f"{token}.{client.thumbprint}"
+            if acme_mode == "standalone":
+                responder.tokens[token] = key_authorization
+                stack.callback(responder.tokens.pop, token, None)
+            else:
+                challenge_dir = os.path.join(webroot, ".well-known", "acme-challenge")
+                os.makedirs(challenge_dir, mode=0o755, exist_ok=True)
+                token_path = os.path.join(challenge_dir, token)
+                _atomic_write(token_path, key_authorization, 0o644, uid, gid)
+                stack.callback(os.remove, token_path)
+
+        for authz_url, challenge in challenges:
+            client.post(challenge["url"], {})
+
+        for authz_url, challenge in challenges:
+            authz = client.poll(authz_url, pending=("pending", "processing"))
+            if authz["status"] != "valid":
+                errors = [
+                    c.get("error", {}).get("detail", "")
+                    for c in authz.get("challenges", [])
+                ]
+                raise CommandExecutionError(
+                    f"Validation of {authz['identifier']['value']} failed: "
+                    + " ".join(e for e in errors if e)
+                )
+
+    # reuse the domain key, as long as the keysize did not change
+    os.makedirs(domain_path, mode=0o700, exist_ok=True)
+    os.chown(domain_path, uid, gid)
+    key_path = os.path.join(domain_path, f"{name}.key")
+    if os.path.isfile(key_path) and conf.get("Le_Keylength") == str(keysize):
+        with open(key_path, "rb") as key_file:
+            key_pem = key_file.read()
+    else:
+        key_pem = _pooled_key(user, keysize, keypool)
+        _atomic_write(key_path, key_pem, 0o600, uid, gid)
+
+    csr = _domain_csr(name, domains, key_pem)
+    _atomic_write(
+        os.path.join(domain_path, f"{name}.csr"),
+        csr.public_bytes(serialization.Encoding.PEM),
+        0o644,
+        uid,
+        gid,
+    )
+
+    order = client.poll(order_url, pending=("pending",))
+    if order["status"] == "ready":
+        client.post(
+            order["finalize"],
+            {"csr": _b64(csr.public_bytes(serialization.Encoding.DER))},
+        )
+        order = client.poll(order_url, pending=("ready", "processing"))
+    if order["status"] != "valid":
+        raise CommandExecutionError(f"Order of {name} is {order['status']}")
+
+    chain = client.post(order["certificate"]).text
+    certs = re.findall(
+        r"-----BEGIN CERTIFICATE-----.+?-----END CERTIFICATE-----\n?",
+        chain,
+        re.DOTALL,
+    )
+    if not certs:
+        raise CommandExecutionError(f"No certificate received for {name}")
+
+    _atomic_write(os.path.join(domain_path, f"{name}.cer"), certs[0], 0o644, uid, gid)
+    _atomic_write(
+        os.path.join(domain_path, "ca.cer"), "".join(certs[1:]), 0o644, uid, gid
+    )
+    _atomic_write(
+        os.path.join(domain_path, "fullchain.cer"), "".join(certs), 0o644, uid, gid
+    )
+
+    # the same keys as acme.sh, so info, list_crt and the state keep working
+    now = int(time.time())
+    next_renew = now + 60 * 86400 - 86400
+    conf.update(
+        {
+            "Le_Domain": name,
+            "Le_Alt": ",".join(domains[1:]) or "no",
+            "Le_Webroot": webroot if acme_mode == "webroot" else "no",
+            "Le_API": client.directory_url,
+            "Le_Keylength": str(keysize),
+            "Le_OrderFinalize": order["finalize"],
+            "Le_LinkOrder": order_url,
+            "Le_LinkCert": order["certificate"],
+            "Le_CertCreateTime": str(now),
+            "Le_CertCreateTimeStr": time.strftime(
+                "%Y-%m-%dT%H:%M:%SZ", time.gmtime(now)
+            ),
+            "Le_NextRenewTimeStr": time.strftime(
+                "%Y-%m-%dT%H:%M:%SZ", time.gmtime(next_renew)
+            ),
+            "Le_NextRenewTime": str(next_renew),
+            "Le_Backend": "python",
+        }
+    )
+    if acme_mode == "standalone" and http_port:
+        conf["Le_HTTPPort"] = str(http_port)
+    conf.pop("DOMAIN_CONF", None)
+    _atomic_write(
+        conf_path,
+        "".join(f"{key}={_quote_conf(value)}\n" for key, value in conf.items()),
+        0o644,
+        uid,
+        gid,
+    )
+    _info_cache_invalidate(name, user, cert_path)
+
+    return _generate_crt_ret(name, cert_path)
+
+
+def _python_renew(name, user="root", cert_path=None, force=False, insecure=False):
+    """
+    Renew a certificate with the python backend, based on its domain conf
+    """
+
+    cert_path = _default_cert_path(user, cert_path)
+    conf = _read_conf(os.path.join(_domain_dir(cert_path, name), f"{name}.conf"))
+
+    if not conf or "Le_Domain" not in conf:
+        return f"Domain {name} is not an issued domain"
+
+    if not force and int(time.time()) < int(conf.get("Le_NextRenewTime", 0)):
+        return (
+            f"Next renewal time is {conf.get('Le_NextRenewTimeStr')}, "
+            "add force=True to renew"
+        )
+
+    webroot = conf.get("Le_Webroot", "no")
+    alt = conf.get("Le_Alt", "no")
+
+    return _python_issue(
+        name,
+        "standalone" if webroot == "no" else "webroot",
+        aliases=None if alt == "no" else alt,
+        server=conf.get("Le_API", "letsencrypt"),
+        keysize=conf.get("Le_Keylength", "4096"),
+        webroot=None if webroot == "no" else webroot,
+        http_port=conf.get("Le_HTTPPort"),
+        user=user,
+        cert_path=cert_path,
+        force=True,
+        insecure=insecure,
+    )
+
+
+def revoke(name, user="root", cert_path=None, backend="acme.sh", insecure=False):
+    """
+    Revoke a certificate
+
+    name
+      Common name of the certificate (main_domain)
+
+    user
+      run the command as a specified user
+      default: root
+
+    cert_path
+      installation dir of certs
+      default: ~/.acme.sh
+
+    backend
+      acme.sh or python
+      default: acme.sh
+
+    insecure
+      disable ssl verification
+      default: False
+    """
+
+    if backend == "python":
+        _check_python_backend()
+        domain_dir = _domain_dir(_default_cert_path(user, cert_path), name)
+        conf = _read_conf(os.path.join(domain_dir, f"{name}.conf")) or {}
+        try:
+            with open(os.path.join(domain_dir, f"{name}.cer"), "rb") as cer:
+                crt = x509.load_pem_x509_certificate(cer.read())
+        except (OSError, ValueError):
+            __context__["retcode"] = 1
+            return f"Certificate {name} does not exist"
+
+        client = _acme_client(user, conf.get("Le_API", "letsencrypt"), insecure)
+        client.account(_account_email(user))
+        try:
+            client.post(
+                client.directory["revokeCert"],
+                {"certificate": _b64(crt.public_bytes(serialization.Encoding.DER))},
+            )
+        except (CommandExecutionError, requests.RequestException) as err:
+            __context__["retcode"] = 1
+            return str(err)
+
+        __context__["retcode"] = 0
+        return f"Certificate {name} has been revoked"
+
+    acme_bin = _acme_bin(user)
+
+    cmd = [acme_bin, "--revoke", "--domain", name]
+
+    if cert_path:
+        cmd.extend(["--cert-home", cert_path])
+    cmd.extend(_ecc_args(_domain_dir(_default_cert_path(user, cert_path), name)))
+
+    if insecure:
+        cmd.append("--insecure")
+
+    revoke_cmd = _run_acme(cmd, user, "revoke", domain=name)
+
+    if revoke_cmd["retcode"] == 0:
+        ret = f"Certificate {name} has been revoked"
+    else:
+        ret = revoke_cmd
+
+    return ret
@@ -0,0 +1,324 @@
+"""
+acme.sh runner
+
+Issues certificates which are shared by several minions once on an
+issuer minion and distributes the files to the minions, and answers
+fleet-wide queries from the mine data of acme_sh.inventory.
+"""
+
+import hashlib
+import logging
+import time
+
+import salt.client
+
+log = logging.getLogger(__name__)
+
+# options of acme_sh.cert which change the issued certificate
+_SPEC_OPTIONS = (
+    "acme_mode",
+    "aliases",
+    "server",
+    "keysize",
+    "dns_plugin",
+    "dns_credentials",
+    "valid_to",
+    "valid_from",
+    "insecure",
+    "dnssleep",
+)
+
+if "__opts__" not in globals():
+    __opts__ = {}
+
+if "__salt__" not in globals():
+    __salt__ = {}
+
+
+def _spec(domain, cert_config):
+    spec = {key: value for key, value in cert_config.items() if key in _SPEC_OPTIONS}
+    spec["name"] = domain
+    spec.setdefault("server", "letsencrypt")
+    spec["keysize"] = str(spec.get("keysize", "4096"))
+    if isinstance(spec.get("aliases"), list):
+        spec["aliases"] = ",".join(spec["aliases"])
+    return spec
+
+
+def _shared_specs(pillars):
+    """
+    Collect the shared certificates of all minion pillars
+
+    Returns the unique specs, the minions of every domain
+    and the domains which can not be shared.
+    """
+
+    specs = {}
+    targets = {}
+    errors = {}
+
+    for minion, pillar in sorted(pillars.items()):
+        if not isinstance(pillar, dict):
+            continue
+
+        for user, config in pillar.items():
+            if not isinstance(config, dict) or not isinstance(
+                config.get("certs"), dict
+            ):
+                continue
+
+            for domain, cert_config in config["certs"].items():
+                cert_config = cert_config or {}
+                if not cert_config.get("shared"):
+                    continue
+
+                spec = _spec(domain, cert_config)
+                if spec.get("acme_mode") != "dns":
+                    errors[domain] = (
+                        "Only certificates with acme_mode dns can be shared"
+                    )
+                elif specs.setdefault(domain, spec) != spec:
+                    errors[domain] = f"The certificate of {minion} differs"
+
+                targets.setdefault(domain, []).append(
+                    (minion, user, cert_config.get("cert_path"))
+                )
+
+    for domain in errors:
+        specs.pop(domain, None)
+        targets.pop(domain, None)
+
+    return specs, targets, errors
+
+
+def _distribute(client, domain, files, targets, timeout):
+    """
+    Push the files of domain to all targets, only changed files are sent
+    """
+
+    file_hashes = {
+        file_name: hashlib.sha256(content.encode()).hexdigest()
+        for file_name, content in files.items()
+    }
+
+    # one call per user and cert_path of the targets
+    groups = {}
+    for minion, user, cert_path in targets:
+        groups.setdefault((user, cert_path), []).append(minion)
+
+    ret = {}
+    for (user, cert_path), minions in groups.items():
+        kwarg = {"user": user, "cert_path": cert_path}
+        current = client.cmd(
+            minions,
+            "acme_sh.cert_hashes",
+            [domain],
+            tgt_type="list",
+            kwarg=kwarg,
+            timeout=timeout,
+        )
+
+        # minions with the same outdated files get one call
+        pushes = {}
+        for minion in minions:
+            if not isinstance(current.get(minion), dict):
+                ret[minion] = current.get(minion, "Minion did not return")
+                continue
+            changed = tuple(
+                sorted(
+                    file_name
+                    for file_name, file_hash in file_hashes.items()
+                    if current[minion].get(file_name) != file_hash
+                )
+            )
+            if changed:
+                pushes.setdefault(changed, []).append(minion)
+            else:
+                ret[minion] = []
+
+        for changed, push_minions in pushes.items():
+            log.debug("Push %s of %s to %s", ", ".join(changed), domain, push_minions)
+            ret.update(
+                client.cmd(
+                    push_minions,
+                    "acme_sh.put_cert_files",
+                    [domain, {file_name: files[file_name] for file_name in changed}],
+                    tgt_type="list",
+                    kwarg=kwarg,
+                    timeout=timeout,
+                )
+            )
+
+    return ret
+
+
+def issue_shared(
+    issuer,
+    tgt="*",
+    tgt_type="glob",
+    user="root",
+    cert_path=None,
+    concurrency=4,
+    timeout=900,
+):
+    """
+    Issue the shared certificates of the targeted minions once and
+    distribute them
+
+    Certificates with ``shared: True`` in the ``acme_sh`` pillar of the
+    minions are collected, every domain is issued (or renewed, if due)
+    once on the issuer with acme_sh.issue_many. The certificate files are
+    written to the cert_path of every minion, files with the same sha256
+    are not transferred again.
+
+    Only certificates with acme_mode dns can be shared, the spec of a
+    domain has to be the same on all minions.
+
+    issuer
+      minion which issues the certificates, e.g. the minion of the master
+
+    tgt
+      minions to collect the shared certificates from
+      default: *
+
+    tgt_type
+      target type of tgt
+      default: glob
+
+    user
+      user of acme.sh on the issuer
+      default: root
+
+    cert_path
+      cert path on the issuer
+      default: ~/.acme.sh
+
+    concurrency
+      maximum number of certificates issued at the same time
+
+    timeout
+      seconds to wait for the minions
+      default: 900
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt-run acme_sh.issue_shared issuer=salt tgt='web*'
+    """
+
+    client = salt.client.get_local_client(__opts__["conf_file"])
+
+    pillars = client.cmd(
+        tgt, "pillar.get", ["acme_sh"], tgt_type=tgt_type, timeout=timeout
+    )
+    specs, targets, errors = _shared_specs(pillars)
+
+    ret = {
+        domain: {"result": False, "comment": error, "minions": {}}
+        for domain, error in errors.items()
+    }
+    if not specs:
+        return ret
+
+    issue_specs = [
+        dict(spec, user=user, cert_path=cert_path) for spec in specs.values()
+    ]
+    issued = client.cmd(
+        issuer,
+        "acme_sh.issue_many",
+        [issue_specs],
+        kwarg={"concurrency": concurrency},
+        timeout=timeout,
+    ).get(issuer)
+
+    if not isinstance(issued, dict):
+        for domain in specs:
+            ret[domain] = {
+                "result": False,
+                "comment": f"Issuer {issuer} did not return: {issued}",
+                "minions": {},
+            }
+        return ret
+
+    for domain in specs:
+        result = issued.get(domain)
+        if isinstance(result, dict) and "certificate" in result:
+            comment = "Certificate has been issued"
+        elif isinstance(result, str) and "re run with `force=True`" in result:
+            comment = "Certificate is already up-to-date"
+        else:
+            ret[domain] = {"result": False, "comment": result, "minions": {}}
+            continue
+
+        files = client.cmd(
+            issuer,
+            "acme_sh.cert_files",
+            [domain],
+            kwarg={"user": user, "cert_path": cert_path},
+            timeout=timeout,
+        ).get(issuer)
+        if not isinstance(files, dict):
+            ret[domain] = {"result": False, "comment": files, "minions": {}}
+            continue
+
+        minions = _distribute(client, domain, files, targets[domain], timeout)
+        ret[domain] = {
+            "result": all(isinstance(x, list) for x in minions.values()),
+            "comment": comment,
+            "minions": minions,
+        }
+
+    return ret
+
+
+def expiring(days=14, tgt="*", tgt_type="glob"):
+    """
+    List the certificates of the fleet which expire within days
+
+    The answer is computed from the mine data of acme_sh.inventory,
+    no minion is contacted. Certificates without a known expiry are
+    left out.
+
+    days
+      days from now
+      default: 14
+
+    tgt
+      minions to look at
+      default: *
+
+    tgt_type
+      target type of tgt
+      default: glob
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt-run acme_sh.expiring days=30
+    """
+
+    limit = time.time() + float(days) * 86400
+    mine = __salt__["mine.get"](tgt, "acme_sh.inventory", tgt_type=tgt_type)
+
+    ret = {}
+    for minion, certs in sorted(mine.items()):
+        if not isinstance(certs, list):
+            continue
+        due = [
+            dict(
+                cert,
+                expires_str=time.strftime(
+                    "%Y-%m-%dT%H:%M:%SZ", time.gmtime(cert["expires"])
+                ),
+            )
+            for cert in certs
+            if isinstance(cert, dict)
+            and cert.get("expires") is not None
+            and cert["expires"] < limit
+        ]
+        if due:
+            ret[minion] = sorted(due, key=lambda cert: cert["expires"])
+
+    return ret
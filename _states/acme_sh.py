@@ -10,6 +10,28 @@ import salt.exceptions
 
 log = logging.getLogger(__name__)
 
+# arguments of acme_sh.cert which can be used in acme_sh.certs
+_CERT_OPTIONS = (
+    "acme_mode",
+    "aliases",
+    "server",
+    "keysize",
+    "dns_plugin",
+    "webroot",
+    "http_port",
+    "cert_path",
+    "dns_credentials",
+    "force",
+    "valid_to",
+    "valid_from",
+    "insecure",
+    "responder",
+    "backend",
+    "keypool",
+    "renew_window",
+    "trace",
+)
+
 if "__context__" not in globals():
     __context__ = {}
 
@@ -35,6 +57,9 @@ def installed(
     user="root",
     upgrade=False,
     force=False,
+    source=None,
+    source_hash=None,
+    source_rev=None,
 ):
     """
     Ensure that acme.sh is installed
@@ -50,8 +75,24 @@ def installed(
 
     force
       Force reinstallation of acme.sh
+
+    source
+      Git repository, local mirror or tarball of acme.sh
+      default = https://github.com/acmesh-official/acme.sh
+
+    source_hash
+      sha256 of the tarball, for git sources sha256 of the acme.sh script
+
+    source_rev
+      Git revision to install
     """
 
+    source_args = {
+        "source": source,
+        "source_hash": source_hash,
+        "source_rev": source_rev,
+    }
+
     ret = {
         "name": name,
         "changes": {},
@@ -70,7 +111,7 @@ def installed(
             return ret
 
         # Install acme.sh
-        if __salt__["acme_sh.install"](email, user=user):
+        if __salt__["acme_sh.install"](email, user=user, **source_args):
             ret["changes"]["acme_sh"] = "Installed"
             ret["comment"] = "acme.sh has been installed"
         # if failed to install acme.sh
@@ -87,7 +128,7 @@ def installed(
             return ret
 
         # Reinstall acme.sh
-        if __salt__["acme_sh.install"](email, user=user, force=force):
+        if __salt__["acme_sh.install"](email, user=user, force=force, **source_args):
             ret["changes"]["acme_sh"] = "Reinstalled"
             ret["comment"] = "acme.sh has been reinstalled"
         # if failed to reinstall acme.sh
@@ -103,7 +144,9 @@ def installed(
             ret["comment"] = "acme.sh would be upgraded"
             return ret
 
-        upgrade_cmd = __salt__["acme_sh.install"](email, user=user, upgrade=upgrade)
+        upgrade_cmd = __salt__["acme_sh.install"](
+            email, user=user, upgrade=upgrade, **source_args
+        )
         if isinstance(upgrade_cmd, str):
             ret["comment"] = "Up-to-date"
         elif isinstance(upgrade_cmd, dict):
@@ -132,6 +175,11 @@ def cert(
     valid_to=None,
     valid_from=None,
     insecure=False,
+    responder=False,
+    backend="acme.sh",
+    keypool=0,
+    renew_window=0,
+    trace=False,
 ):
     """
     Ensure that a certificate is issued
@@ -197,6 +245,103 @@ def cert(
     insecure
       Disable SSL certificate verification
       default = False
+
+    responder
+      Answer http-01 challenges with the built-in responder on http_port,
+      standalone certificates on the same port can be issued in parallel
+      default = False
+
+    backend
+      acme.sh or python, python talks to the ACME server directly
+      and supports the webroot and standalone modes
+      default = acme.sh
+
+    keypool
+      Take new private keys from a pre-generated pool, the pool is
+      refilled up to this number of keys in runs without an order
+      default = 0
+
+    renew_window
+      Hours after the renewal time the renewal is delayed by a stable
+      offset of minion and domain, to spread the renewals of a fleet
+      default = 0
+
+    trace
+      Add the durations of the phases of a new issue to the changes
+      default = False
+    """
+
+    ret = {
+        "name": name,
+        "changes": {},
+        "result": True,
+        "comment": "",
+    }
+
+    _check_cert_args(
+        acme_mode,
+        aliases=aliases,
+        dns_plugin=dns_plugin,
+        webroot=webroot,
+        dns_credentials=dns_credentials,
+        valid_to=valid_to,
+        valid_from=valid_from,
+    )
+
+    # check cert is available and set for renewal
+
+    crt_info = __salt__["acme_sh.info"](name, user=user, cert_path=cert_path)
+
+    if __context__["acme_sh.info"]["code"] == 1:
+        crt_info = None
+
+    start = len(__context__.get("acme_sh.metrics", []))
+    ret["result"], ret["comment"], changes = _ensure_cert(
+        name,
+        crt_info,
+        acme_mode,
+        aliases=aliases,
+        server=server,
+        keysize=keysize,
+        dns_plugin=dns_plugin,
+        webroot=webroot,
+        http_port=http_port,
+        user=user,
+        cert_path=cert_path,
+        dns_credentials=dns_credentials,
+        force=force,
+        valid_to=valid_to,
+        valid_from=valid_from,
+        insecure=insecure,
+        responder=responder,
+        backend=backend,
+        keypool=keypool,
+        renew_window=renew_window,
+        trace=trace,
+    )
+    ret["comment"] = _add_metrics(start, ret["result"], ret["comment"], changes)
+
+    if changes:
+        ret["changes"][name] = changes
+    elif keypool and ret["result"] is True:
+        _refill_keypool(user, keysize, keypool)
+
+    return ret
+
+
+def certs(name, certs, user="root"):
+    """
+    Ensure that all certificates of a user are issued
+
+    Every cert_path is scanned once, only domains which are missing
+    or due for renewal are issued or renewed.
+
+    certs
+      Dictionary with the domain as key and the arguments of
+      acme_sh.cert as value, e.g. the certs mapping of the pillar
+
+    user
+      User to issue certificates for
     """
 
     ret = {
@@ -206,7 +351,182 @@ def cert(
         "comment": "",
     }
 
-    # error checking
+    if not isinstance(certs, dict):
+        raise salt.exceptions.SaltInvocationError("certs must be a dictionary")
+
+    domains = {}
+    for domain, cert_config in certs.items():
+        cert_config = {
+            key: value
+            for key, value in (cert_config or {}).items()
+            if key in _CERT_OPTIONS
+        }
+        if "acme_mode" not in cert_config:
+            raise salt.exceptions.SaltInvocationError(
+                f"acme_mode must be specified for {domain}"
+            )
+        _check_cert_args(**cert_config)
+        domains[domain] = cert_config
+
+    # one directory scan per cert_path
+    crt_infos = {}
+    for cert_path in {cert_config.get("cert_path") for cert_config in domains.values()}:
+        crt_infos[cert_path] = __salt__["acme_sh.info_all"](
+            user=user, cert_path=cert_path
+        )
+
+    # the pending certificates are checked at once before any order
+    pending = [
+        domain
+        for domain, cert_config in domains.items()
+        if _pending(
+            domain, crt_infos[cert_config.get("cert_path")].get(domain), **cert_config
+        )
+    ]
+    reports = {}
+    if pending and not __opts__["test"]:
+        reports = __salt__["acme_sh.preflight"](
+            [
+                _preflight_spec(domain, user=user, **domains[domain])
+                for domain in pending
+            ]
+        )
+
+    counts = {}
+    failed = []
+    pools = {}
+    for domain, cert_config in domains.items():
+        crt_info = crt_infos[cert_config.get("cert_path")].get(domain)
+
+        start = len(__context__.get("acme_sh.metrics", []))
+        result, comment, changes = _ensure_cert(
+            domain, crt_info, user=user, preflight=reports.get(domain), **cert_config
+        )
+        comment = _add_metrics(start, result, comment, changes)
+
+        if changes:
+            ret["changes"][domain] = changes
+
+        if result is False:
+            ret["result"] = False
+            failed.append(f"{domain}: {comment}")
+            continue
+        if result is None and ret["result"] is True:
+            ret["result"] = None
+        counts[comment] = counts.get(comment, 0) + 1
+
+        if cert_config.get("keypool") and result is True and not changes:
+            keysize = str(cert_config.get("keysize", "4096"))
+            pools[keysize] = max(pools.get(keysize, 0), int(cert_config["keypool"]))
+
+    for keysize, depth in pools.items():
+        _refill_keypool(user, keysize, depth)
+
+    comments = [f"{count} x {comment}" for comment, count in sorted(counts.items())]
+    if failed:
+        comments.append("Failed certificates:")
+        comments.extend(failed)
+    ret["comment"] = "\n".join(comments)
+
+    return ret
+
+
+def _pending(name, crt_info, force=False, renew_window=0, **kwargs):
+    """
+    Check if a certificate has to be issued or renewed
+    """
+
+    if crt_info is None or "Le_NextRenewTime" not in crt_info or force:
+        return True
+
+    next_renew = int(crt_info["Le_NextRenewTime"])
+    if renew_window:
+        next_renew += __salt__["acme_sh.renew_offset"](name, renew_window)
+    return int(time.time()) > next_renew
+
+
+def _preflight_spec(
+    name,
+    acme_mode,
+    user="root",
+    keysize="4096",
+    dns_plugin=None,
+    webroot=None,
+    http_port=None,
+    dns_credentials=None,
+    responder=False,
+    backend="acme.sh",
+    **kwargs,
+):
+    return {
+        "name": name,
+        "acme_mode": acme_mode,
+        "user": user,
+        "keysize": str(keysize),
+        "dns_plugin": dns_plugin,
+        "webroot": webroot,
+        "http_port": http_port,
+        "dns_credentials": dns_credentials,
+        "responder": responder,
+        "backend": backend,
+    }
+
+
+def _refill_keypool(user, keysize, depth):
+    """
+    Fill the key pool of user, the keys are generated now
+
+    Only called in runs without an order, so the key generation never
+    delays an issue.
+    """
+
+    if __opts__["test"]:
+        return
+
+    fill = __salt__["acme_sh.keypool_fill"](
+        keysize=str(keysize), depth=int(depth), user=user
+    )
+    if not isinstance(fill, dict):
+        log.warning("Unable to fill the %s key pool of %s: %s", keysize, user, fill)
+
+
+def _add_metrics(start, result, comment, changes):
+    """
+    Add the timings of the acme.sh calls since start to the changes,
+    a failed call is summarized in the returned comment
+    """
+
+    metrics = __context__.get("acme_sh.metrics", [])[start:]
+    if not metrics:
+        return comment
+
+    if changes:
+        changes["metrics"] = [
+            {key: metric[key] for key in ("function", "duration", "failure")}
+            for metric in metrics
+        ]
+    if result is False and metrics[-1]["failure"]:
+        comment = (
+            f"{comment} ({metrics[-1]['function']} failed after "
+            f"{metrics[-1]['duration']}s: {metrics[-1]['failure']})"
+        )
+
+    return comment
+
+
+def _check_cert_args(
+    acme_mode,
+    aliases=None,
+    dns_plugin=None,
+    webroot=None,
+    dns_credentials=None,
+    valid_to=None,
+    valid_from=None,
+    **kwargs,
+):
+    """
+    Raise SaltInvocationError on invalid certificate arguments
+    """
 
     # aliases can be a string ?
     if aliases and aliases != "None" and not isinstance(aliases, list):
@@ -238,32 +558,74 @@ def cert(
             "webroot must be specified when acme_mode is webroot"
         )
 
-    # check cert is available and set for renewal
 
-    crt_info = __salt__["acme_sh.info"](name, user=user, cert_path=cert_path)
+def _ensure_cert(
+    name,
+    crt_info,
+    acme_mode,
+    aliases=None,
+    server=None,
+    keysize="4096",
+    dns_plugin=None,
+    webroot=None,
+    http_port=None,
+    user="root",
+    cert_path=None,
+    dns_credentials=None,
+    force=False,
+    valid_to=None,
+    valid_from=None,
+    insecure=False,
+    responder=False,
+    backend="acme.sh",
+    keypool=0,
+    renew_window=0,
+    trace=False,
+    preflight=None,
+):
+    """
+    Issue or renew a certificate based on the already read crt_info
+
+    crt_info is None if the certificate does not exist.
+    preflight is the report of acme_sh.preflight, it is checked here if None.
+    Returns a tuple with result, comment and changes.
+    """
 
-    if (
-        __context__["acme_sh.info"]["code"] == 1
-        or "Le_NextRenewTime" not in crt_info
-        or force
-    ):
+    # fail before an order is placed, if the problem can be found locally
+    if not __opts__["test"] and _pending(name, crt_info, force, renew_window):
+        if preflight is None:
+            spec = _preflight_spec(
+                name,
+                acme_mode,
+                user=user,
+                keysize=keysize,
+                dns_plugin=dns_plugin,
+                webroot=webroot,
+                http_port=http_port,
+                dns_credentials=dns_credentials,
+                responder=responder,
+                backend=backend,
+            )
+            preflight = __salt__["acme_sh.preflight"]([spec])[name]
+        if not preflight["result"]:
+            return False, f"Preflight failed: {'; '.join(preflight['problems'])}", {}
+
+    if crt_info is None or "Le_NextRenewTime" not in crt_info or force:
         log.debug("Certificate is not available or force is enabled")
         # if test mode is enabled
         if __opts__["test"]:
-            ret["result"] = None
-            ret["comment"] = "Certificate would be issued"
-            return ret
+            return None, "Certificate would be issued", {}
 
         # issue certificate
         issue = __salt__["acme_sh.issue"](
             name,
             acme_mode,
             aliases=",".join(aliases) if aliases else None,
-            server=server,
+            server=server or "letsencrypt",
             keysize=str(keysize),
             dns_plugin=dns_plugin,
             webroot=webroot,
-            http_port=str(http_port),
+            http_port=str(http_port) if http_port else None,
             user=user,
             cert_path=cert_path,
             dns_credentials=dns_credentials,
@@ -271,24 +633,27 @@ def cert(
             valid_to=valid_to,
             valid_from=valid_from,
             insecure=insecure,
+            responder=responder,
+            backend=backend,
+            keypool=keypool,
+            trace=trace,
         )
 
-        if __context__["retcode"] == 0:
-            ret["changes"][name] = issue
-            ret["comment"] = "Certificate has been issued"
-            # if failed to issue certificate
-        else:
-            ret["result"] = False
-            ret["comment"] = issue["stderr"]
+        # the result decides, retcode may be left over from acme_sh.info
+        if isinstance(issue, dict) and "certificate" in issue:
+            return True, "Certificate has been issued", issue
+        # if failed to issue certificate
+        return False, _error_comment(issue), {}
 
     # if certificate is available and set for renewal
-    elif int(time.time()) > int(crt_info["Le_NextRenewTime"]):
+    next_renew = int(crt_info["Le_NextRenewTime"])
+    if renew_window:
+        next_renew += __salt__["acme_sh.renew_offset"](name, renew_window)
+    if int(time.time()) > next_renew:
         log.debug("Certificate is available and set for renewal")
         # if test mode is enabled
         if __opts__["test"]:
-            ret["result"] = None
-            ret["comment"] = "Certificate would be renewed"
-            return ret
+            return None, "Certificate would be renewed", {}
 
         # renew certificate
         renew = __salt__["acme_sh.renew"](
@@ -297,16 +662,249 @@ def cert(
             cert_path=cert_path,
             force=force,
             insecure=insecure,
+            backend=backend,
         )
 
-        if __context__["retcode"] == 0:
-            ret["changes"][name] = renew
-            ret["comment"] = "Certificate has been renewed"
+        if isinstance(renew, dict) and "certificate" in renew:
+            return True, "Certificate has been renewed", renew
         # if failed to renew certificate
+        return False, _error_comment(renew), {}
+
+    # reissue if the certificate on disk does not match the requested one
+    drift = __salt__["acme_sh.check_drift"](
+        name,
+        aliases=",".join(aliases) if aliases else None,
+        keysize=str(keysize),
+        user=user,
+        cert_path=cert_path,
+    )
+
+    if drift:
+        log.debug("Certificate %s drifted: %s", name, drift)
+        if __opts__["test"]:
+            return None, "Certificate would be reissued", {"drift": drift}
+
+        result, comment, changes = _ensure_cert(
+            name,
+            None,
+            acme_mode,
+            aliases=aliases,
+            server=server,
+            keysize=keysize,
+            dns_plugin=dns_plugin,
+            webroot=webroot,
+            http_port=http_port,
+            user=user,
+            cert_path=cert_path,
+            dns_credentials=dns_credentials,
+            force=True,
+            valid_to=valid_to,
+            valid_from=valid_from,
+            insecure=insecure,
+            responder=responder,
+            backend=backend,
+            keypool=keypool,
+            renew_window=renew_window,
+            trace=trace,
+        )
+        if not result:
+            return result, comment, changes
+
+        # a reissue which does not clear the drift would repeat every run
+        remaining = __salt__["acme_sh.check_drift"](
+            name,
+            aliases=",".join(aliases) if aliases else None,
+            keysize=str(keysize),
+            user=user,
+            cert_path=cert_path,
+        )
+        changes["drift"] = drift
+        if remaining:
+            return (
+                False,
+                f"Certificate has been reissued, but still drifts: {', '.join(remaining)}",
+                changes,
+            )
+        return True, "Certificate has been reissued", changes
+
+    return True, "Certificate is already up-to-date", {}
+
+
+def deployed(
+    name,
+    user="root",
+    cert_path=None,
+    cert=None,
+    key=None,
+    fullchain=None,
+    ca=None,
+    owner=None,
+    group=None,
+    mode="0644",
+    key_mode="0600",
+    reload=None,
+    reload_cmd=None,
+):
+    """
+    Ensure that the files of a certificate are installed to target paths
+
+    Only files with a different content are written. If a file was
+    written, the reloads are queued and run once by acme_sh.reloaded.
+
+    name
+      Domain of the certificate
+
+    user
+      Owner of the certificate
+
+    cert_path
+      Path the certificate is stored at
+      default = ~/.acme.sh
+
+    cert
+      Target path of the certificate
+
+    key
+      Target path of the private key
+
+    fullchain
+      Target path of the certificate with the intermediate certificates
+
+    ca
+      Target path of the intermediate certificates
+
+    owner
+      Owner of the written files
+
+    group
+      Group of the written files
+
+    mode
+      Mode of the written certificate files
+      default = 0644
+
+    key_mode
+      Mode of the written private key
+      default = 0600
+
+    reload
+      Service or list of services to reload after a change
+
+    reload_cmd
+      Command or list of commands to run after a change
+    """
+
+    ret = {
+        "name": name,
+        "changes": {},
+        "result": True,
+        "comment": "",
+    }
+
+    deploy = __salt__["acme_sh.deploy"](
+        name,
+        user=user,
+        cert_path=cert_path,
+        cert=cert,
+        key=key,
+        fullchain=fullchain,
+        ca=ca,
+        owner=owner,
+        group=group,
+        mode=mode,
+        key_mode=key_mode,
+        test=__opts__["test"],
+    )
+
+    if not isinstance(deploy, dict):
+        ret["result"] = False
+        ret["comment"] = _error_comment(deploy)
+        return ret
+
+    if not deploy:
+        ret["comment"] = "Certificate files are already deployed"
+        return ret
+
+    # every distinct reload runs once in acme_sh.reloaded
+    queue = __context__.setdefault("acme_sh.reload", [])
+    for hook in [("service", x) for x in _as_list(reload)] + [
+        ("cmd", x) for x in _as_list(reload_cmd)
+    ]:
+        if hook not in queue:
+            queue.append(hook)
+
+    if __opts__["test"]:
+        ret["result"] = None
+        ret["comment"] = "Certificate files would be deployed"
+    else:
+        ret["comment"] = "Certificate files have been deployed"
+    ret["changes"] = deploy
+
+    return ret
+
+
+def reloaded(name):
+    """
+    Run the reloads queued by acme_sh.deployed, every reload once
+
+    Use with ``order: last``, so the reloads of all deployed
+    certificates of the run are collected.
+    """
+
+    ret = {
+        "name": name,
+        "changes": {},
+        "result": True,
+        "comment": "",
+    }
+
+    queue = __context__.pop("acme_sh.reload", [])
+    if not queue:
+        ret["comment"] = "No reload queued"
+        return ret
+
+    if __opts__["test"]:
+        ret["result"] = None
+        ret["comment"] = "Would reload " + ", ".join(x for _, x in queue)
+        return ret
+
+    failed = []
+    for kind, target in queue:
+        if kind == "service":
+            reloaded_ok = __salt__["service.reload"](target)
         else:
-            ret["result"] = False
-            ret["comment"] = renew["stderr"]
+            reloaded_ok = (
+                __salt__["cmd.run_all"](target, python_shell=True)["retcode"] == 0
+            )
+
+        if reloaded_ok:
+            ret["changes"][target] = "reloaded"
+        else:
+            failed.append(target)
+
+    if failed:
+        ret["result"] = False
+        ret["comment"] = "Failed to reload " + ", ".join(failed)
     else:
-        ret["comment"] = "Certificate is already up-to-date"
+        ret["comment"] = "Reloaded " + ", ".join(ret["changes"])
 
     return ret
+
+
+def _as_list(value):
+    if not value:
+        return []
+    if isinstance(value, str):
+        return [value]
+    return list(value)
+
+
+def _error_comment(cmd_ret):
+    if isinstance(cmd_ret, dict) and "deferred_until" in cmd_ret:
+        return (
+            f"Deferred until {cmd_ret['deferred_until_str']} by the "
+            f"{cmd_ret['limit']} rate limit of {cmd_ret['scope']}"
+        )
+    if isinstance(cmd_ret, dict):
+        return cmd_ret.get("stderr") or cmd_ret.get("stdout", "")
+    return str(cmd_ret)
@@ -0,0 +1,358 @@
+#!/usr/bin/env python3
+"""
+Benchmark of the acme_sh states
+
+Renders and applies acme_sh.cert (or acme_sh.certs with --bulk) with
+salt-call --local for a growing number of certificates and writes the
+results as JSON, see README.md.
+"""
+
+import argparse
+import datetime
+import getpass
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+FORMULA_DIR = os.path.dirname(os.path.dirname(BENCH_DIR))
+FAKE_ACME = os.path.join(BENCH_DIR, "fake_acme.sh")
+FAKE_MARKER = "Stand-in for acme.sh used by bench.py"
+
+PEBBLE_SERVER = "https://localhost:14000/dir"
+PEBBLE_CHALLTESTSRV = "http://localhost:8055"
+
+# no order of the benchmark is deferred by the ledger
+NO_RATELIMITS = {
+    kind: {"limit": 0} for kind in ("orders", "domain", "duplicate", "failures")
+}
+
+
+def _salt_call(conf_dir, *args):
+    """
+    Run salt-call and return the parsed output, the duration and the
+    peak memory of the salt-call process
+    """
+
+    cmd = ["salt-call", "--local", "-c", conf_dir, "--out=json", *args]
+    start = time.monotonic()
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    stdout = proc.stdout.read()
+    proc.stdout.close()
+    # wait4 returns the rusage of this process only
+    _, status, rusage = os.wait4(proc.pid, 0)
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    duration = time.monotonic() - start
+
+    try:
+        output = json.loads(stdout)["local"]
+    except (ValueError, KeyError, TypeError):
+        raise RuntimeError(f"{' '.join(cmd)} failed:\n{stdout.decode()}") from None
+
+    return output, duration, rusage.ru_maxrss
+
+
+def _acme_calls(textfile):
+    """
+    Number of acme.sh processes from the metrics textfile of the module
+    """
+
+    calls = 0
+    try:
+        with open(textfile, encoding="utf-8") as metrics:
+            for line in metrics:
+                if line.startswith("acme_sh_duration_seconds_count"):
+                    calls += int(float(line.rsplit(" ", 1)[1]))
+    except OSError:
+        pass
+    return calls
+
+
+def _cert_config(index, args, work_dir):
+    # the fake acme.sh never validates, a webroot needs neither socat nor a port
+    config = {
+        "acme_mode": "webroot",
+        "webroot": os.path.join(work_dir, "webroot"),
+        "keysize": args.keysize,
+        "cert_path": os.path.join(work_dir, "certs"),
+    }
+    if args.aliases:
+        config["aliases"] = [f"www.bench-{index}.{args.domain}"]
+    if args.mode == "pebble":
+        del config["webroot"]
+        config.update(
+            acme_mode="standalone",
+            server=PEBBLE_SERVER,
+            insecure=True,
+            responder=True,
+            http_port=args.http_port,
+        )
+    return config
+
+
+def _write_config(work_dir, user, certs, args):
+    """
+    Minion config and pillar of a salt-call --local run for certs
+    """
+
+    conf_dir = os.path.join(work_dir, "conf")
+    pillar_dir = os.path.join(work_dir, "pillar")
+    os.makedirs(conf_dir, exist_ok=True)
+    os.makedirs(pillar_dir, exist_ok=True)
+    os.makedirs(
+        os.path.join(work_dir, "webroot", ".well-known", "acme-challenge"),
+        exist_ok=True,
+    )
+
+    minion = {
+        "id": "bench",
+        "file_client": "local",
+        "root_dir": work_dir,
+        "user": user,
+        "file_roots": {"base": [FORMULA_DIR]},
+        "pillar_roots": {"base": [pillar_dir]},
+        "log_file": os.path.join(work_dir, "minion.log"),
+    }
+    with open(os.path.join(conf_dir, "minion"), "w", encoding="utf-8") as conf:
+        json.dump(minion, conf)
+
+    pillar = {
+        "acme_sh": {
+            user: {
+                "email": "bench@example.com",
+                "bulk": args.bulk,
+                "certs": {
+                    f"bench-{index}.{args.domain}": _cert_config(index, args, work_dir)
+                    for index in range(certs)
+                },
+            }
+        },
+        "acme_sh_ratelimits": NO_RATELIMITS,
+        "acme_sh_metrics": {"textfile": os.path.join(work_dir, "acme_sh.prom")},
+    }
+    with open(os.path.join(pillar_dir, "top.sls"), "w", encoding="utf-8") as top:
+        json.dump({"base": {"*": ["bench"]}}, top)
+    with open(os.path.join(pillar_dir, "bench.sls"), "w", encoding="utf-8") as sls:
+        json.dump(pillar, sls)
+
+    return conf_dir
+
+
+def _install_fake(home, delay):
+    """
+    Put fake_acme.sh in place of acme.sh, a real acme.sh is never replaced
+    """
+
+    acme_dir = os.path.join(home, ".acme.sh")
+    acme_bin = os.path.join(acme_dir, "acme.sh")
+    if os.path.exists(acme_bin):
+        with open(acme_bin, encoding="utf-8", errors="replace") as script:
+            if FAKE_MARKER not in script.read(4096):
+                sys.exit(
+                    f"{acme_bin} is a real acme.sh, run the fake mode as another user"
+                )
+
+    os.makedirs(acme_dir, exist_ok=True)
+    shutil.copy(FAKE_ACME, acme_bin)
+    os.chmod(acme_bin, 0o755)
+    with open(os.path.join(acme_dir, "bench.env"), "w", encoding="utf-8") as env:
+        env.write(f"FAKE_ACME_DELAY={delay}\n")
+
+
+def _setup_pebble(home, ip_address):
+    """
+    Resolve every name to the minion in pebble-challtestsrv
+    """
+
+    if not os.path.isfile(os.path.join(home, ".acme.sh", "acme.sh")):
+        sys.exit("Install acme.sh first: salt-call acme_sh.install bench@example.com")
+
+    request = urllib.request.Request(
+        f"{PEBBLE_CHALLTESTSRV}/set-default-ipv4",
+        data=json.dumps({"ip": ip_address}).encode(),
+        headers={"Content-Type": "application/json"},
+    )
+    with urllib.request.urlopen(request, timeout=10):
+        pass
+
+
+def _state_stats(states):
+    durations = sorted(
+        state["duration"] / 1000
+        for state in states.values()
+        if isinstance(state, dict) and "duration" in state
+    )
+    if not durations:
+        return {"count": 0}
+
+    return {
+        "count": len(durations),
+        "sum": round(sum(durations), 3),
+        "mean": round(statistics.fmean(durations), 4),
+        "p50": round(durations[len(durations) // 2], 4),
+        "p95": round(durations[int(len(durations) * 0.95)], 4),
+        "max": round(durations[-1], 4),
+        "failed": sum(1 for state in states.values() if not state.get("result")),
+    }
+
+
+def bench(certs, user, args):
+    """
+    Compile, apply and re-apply the states of certs certificates
+    """
+
+    work_dir = tempfile.mkdtemp(prefix=f"acme_sh-bench-{certs}-")
+    textfile = os.path.join(work_dir, "acme_sh.prom")
+    conf_dir = _write_config(work_dir, user, certs, args)
+    sls = "acme_sh.cert"
+
+    try:
+        _salt_call(conf_dir, "saltutil.sync_all")
+
+        # rendering of pillar and sls
+        _, compile_seconds, compile_rss = _salt_call(
+            conf_dir, "state.show_low_sls", sls
+        )
+        result = {
+            "certs": certs,
+            "compile": {
+                "seconds": round(compile_seconds, 3),
+                "peak_rss_kb": compile_rss,
+            },
+        }
+
+        # the first run issues every certificate, the second one is the
+        # common case of a run without due certificates
+        for run in ("issue", "noop"):
+            calls = _acme_calls(textfile)
+            states, seconds, rss = _salt_call(conf_dir, "state.apply", sls)
+            result[run] = {
+                "seconds": round(seconds, 3),
+                "peak_rss_kb": rss,
+                "acme_sh_calls": _acme_calls(textfile) - calls,
+                "states": _state_stats(states),
+            }
+            print(
+                f"{certs:>6} certs {run:>5}: {seconds:8.2f}s, "
+                f"{result[run]['acme_sh_calls']} acme.sh calls, {rss} kB",
+                file=sys.stderr,
+            )
+    finally:
+        if not args.keep:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    return result
+
+
+def compare(results, baseline, tolerance):
+    """
+    Print the change against baseline, returns False on a regression
+    """
+
+    old = {result["certs"]: result for result in baseline["results"]}
+    ok = True
+    for result in results:
+        previous = old.get(result["certs"])
+        if not previous:
+            continue
+        for run in ("compile", "issue", "noop"):
+            if run not in previous or run not in result:
+                continue
+            change = result[run]["seconds"] / max(previous[run]["seconds"], 0.001) - 1
+            regression = change > tolerance
+            ok = ok and not regression
+            print(
+                f"{result['certs']:>6} certs {run:>7}: {previous[run]['seconds']:8.2f}s -> "
+                f"{result[run]['seconds']:8.2f}s ({change:+.0%})"
+                f"{' REGRESSION' if regression else ''}",
+                file=sys.stderr,
+            )
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument(
+        "--mode",
+        choices=("fake", "pebble"),
+        default="fake",
+        help="fake acme.sh or a real acme.sh against pebble",
+    )
+    parser.add_argument(
+        "--sizes",
+        default="10,100,1000,10000",
+        help="comma separated numbers of certificates",
+    )
+    parser.add_argument("--output", default="-", help="JSON file of the results")
+    parser.add_argument("--baseline", help="JSON file of a previous run to compare")
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.2,
+        help="allowed slowdown against the baseline",
+    )
+    parser.add_argument("--bulk", action="store_true", help="use acme_sh.certs")
+    parser.add_argument("--aliases", action="store_true", help="add a www alias")
+    parser.add_argument("--keysize", default="ec-256")
+    parser.add_argument("--domain", default="example.test")
+    parser.add_argument(
+        "--delay", default="0", help="seconds the fake acme.sh waits per issue"
+    )
+    parser.add_argument("--http-port", default="5002", help="pebble http-01 port")
+    parser.add_argument(
+        "--ip", default="127.0.0.1", help="address pebble validates against"
+    )
+    parser.add_argument("--keep", action="store_true", help="keep the work dirs")
+    args = parser.parse_args()
+
+    user = getpass.getuser()
+    home = os.path.expanduser("~")
+    if args.mode == "fake":
+        _install_fake(home, args.delay)
+    else:
+        _setup_pebble(home, args.ip)
+
+    results = [bench(int(size), user, args) for size in args.sizes.split(",")]
+
+    salt_version = subprocess.run(
+        ["salt-call", "--version"], capture_output=True, text=True, check=False
+    ).stdout.strip()
+    formula_version = subprocess.run(
+        ["git", "-C", FORMULA_DIR, "describe", "--always", "--dirty"],
+        capture_output=True,
+        text=True,
+        check=False,
+    ).stdout.strip()
+    report = {
+        "date": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "formula": formula_version,
+        "salt": salt_version,
+        "python": platform.python_version(),
+        "mode": args.mode,
+        "bulk": args.bulk,
+        "keysize": args.keysize,
+        "results": results,
+    }
+
+    if args.output == "-":
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    else:
+        with open(args.output, "w", encoding="utf-8") as output:
+            json.dump(report, output, indent=2)
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as baseline:
+            if not compare(results, json.load(baseline), args.tolerance):
+                sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
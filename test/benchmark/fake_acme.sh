@@ -0,0 +1,257 @@
+#!/bin/sh
+# Stand-in for acme.sh used by bench.py
+#
+# Writes the same conf and certificate files as acme.sh (self-signed with
+# openssl, ecc certificates in <domain>_ecc) without talking to an ACME
+# server. The settings are read from bench.env next to this script, because
+# salt runs the script with a clean environment:
+#
+#   FAKE_ACME_DELAY  seconds to sleep per issue/renew, simulates the CA
+#   FAKE_ACME_DAYS   validity of the certificates
+#   FAKE_ACME_RENEW  days before expiry the renewal is due
+
+FAKE_ACME_DELAY=0
+FAKE_ACME_DAYS=90
+FAKE_ACME_RENEW=30
+
+# shellcheck source=/dev/null
+[ -f "$(dirname "$0")/bench.env" ] && . "$(dirname "$0")/bench.env"
+
+_log() {
+  echo "[$(date)] $*"
+}
+
+_action=""
+_domains=""
+_cert_home="$HOME/.acme.sh"
+_keylength="4096"
+_server="letsencrypt"
+_force=""
+_webroot="no"
+_csr=""
+_ecc=""
+
+while [ $# -gt 0 ]; do
+  case "$1" in
+  --version | -v) _action="version" ;;
+  --issue | --renew | --info | --list | --register-account | --renew-all | --cron | --revoke | --signcsr)
+    _action="${1#--}"
+    ;;
+  -d | --domain)
+    _domains="$_domains $2"
+    shift
+    ;;
+  --cert-home)
+    _cert_home="$2"
+    shift
+    ;;
+  --keylength | -k)
+    _keylength="$2"
+    shift
+    ;;
+  --server)
+    _server="$2"
+    shift
+    ;;
+  --csr)
+    _csr="$2"
+    shift
+    ;;
+  -w | --webroot)
+    _webroot="$2"
+    shift
+    ;;
+  --dns | --httpport | --tlsport | --dnssleep | -m | --valid-to | --valid-from)
+    shift
+    ;;
+  --force | -f) _force="1" ;;
+  --ecc) _ecc="1" ;;
+  esac
+  shift
+done
+
+set -- $_domains
+_main="$1"
+
+_conf_value() {
+  sed -n "s/^$2='\(.*\)'$/\1/p" "$1"
+}
+
+# ecc certificates are kept in <main>_ecc, like acme.sh does
+_domain_dir() {
+  case "$_keylength" in
+  ec-*) echo "$_cert_home/${_main}_ecc" ;;
+  *) echo "$_cert_home/$_main" ;;
+  esac
+}
+
+# --renew, --info and --revoke use the ecc dir with --ecc or without a
+# rsa certificate of the domain
+_issued_dir() {
+  if [ -n "$_ecc" ] || [ ! -f "$_cert_home/$_main/$_main.conf" ]; then
+    echo "$_cert_home/${_main}_ecc"
+  else
+    echo "$_cert_home/$_main"
+  fi
+}
+
+_issue() {
+  _dir="$(_domain_dir)"
+  _conf="$_dir/$_main.conf"
+  _now="$(date +%s)"
+
+  # like acme.sh, a csr is only signed for a domain without a key
+  if [ -n "$_csr" ] && [ -f "$_dir/$_main.key" ]; then
+    _log "Domain key exists, do you want to overwrite the key?"
+    _log "Add '--force', and try again."
+    return 1
+  fi
+
+  if [ -z "$_force" ] && [ -f "$_conf" ]; then
+    _next="$(_conf_value "$_conf" Le_NextRenewTime)"
+    if [ -n "$_next" ] && [ "$_now" -lt "$_next" ]; then
+      _log "Skip, Next renewal time is: $(_conf_value "$_conf" Le_NextRenewTimeStr)"
+      _log "Add '--force' to force to renew."
+      return 2
+    fi
+  fi
+
+  _log "Using CA: $_server"
+  _log "Single domain='$_main'"
+  _log "Getting domain auth token for each domain"
+  _log "Verifying: $_main"
+  [ "$FAKE_ACME_DELAY" != "0" ] && sleep "$FAKE_ACME_DELAY"
+  _log "Success"
+  _log "Verify finished, start to sign."
+
+  case "$_keylength" in
+  ec-256) _newkey="ec -pkeyopt ec_paramgen_curve:prime256v1" ;;
+  ec-384) _newkey="ec -pkeyopt ec_paramgen_curve:secp384r1" ;;
+  ec-521) _newkey="ec -pkeyopt ec_paramgen_curve:secp521r1" ;;
+  *) _newkey="rsa:$_keylength" ;;
+  esac
+
+  _san=""
+  _alt=""
+  for _domain in "$@"; do
+    _san="${_san:+$_san,}DNS:$_domain"
+    [ "$_domain" != "$_main" ] && _alt="${_alt:+$_alt,}$_domain"
+  done
+
+  mkdir -p "$_dir"
+  if [ -n "$_csr" ]; then
+    # the csr is signed by a throwaway ca, the domain key stays unknown
+    cp "$_csr" "$_dir/$_main.csr"
+    if ! openssl req -x509 -newkey rsa:2048 -nodes -days 1 -subj "/CN=fake ca" \
+      -keyout "$_dir/.ca.key" -out "$_dir/.ca.cer" 2>/dev/null ||
+      ! openssl x509 -req -in "$_csr" -days "$FAKE_ACME_DAYS" -copy_extensions copy \
+        -CA "$_dir/.ca.cer" -CAkey "$_dir/.ca.key" -set_serial "$_now" \
+        -out "$_dir/$_main.cer" 2>/dev/null; then
+      rm -f "$_dir/.ca.key" "$_dir/.ca.cer"
+      _log "Sign failed"
+      return 1
+    fi
+    rm -f "$_dir/.ca.key" "$_dir/.ca.cer"
+  # shellcheck disable=SC2086
+  elif ! openssl req -x509 -newkey $_newkey -nodes -days "$FAKE_ACME_DAYS" \
+    -subj "/CN=$_main" -addext "subjectAltName=$_san" \
+    -keyout "$_dir/$_main.key" -out "$_dir/$_main.cer" 2>/dev/null; then
+    _log "Sign failed"
+    return 1
+  fi
+  cp "$_dir/$_main.cer" "$_dir/ca.cer"
+  cat "$_dir/$_main.cer" "$_dir/ca.cer" >"$_dir/fullchain.cer"
+
+  _next=$((_now + (FAKE_ACME_DAYS - FAKE_ACME_RENEW) * 86400))
+  cat >"$_conf" <<EOF
+Le_Domain='$_main'
+Le_Alt='${_alt:-no}'
+Le_Webroot='$_webroot'
+Le_PreHook=''
+Le_PostHook=''
+Le_RenewHook=''
+Le_API='$_server'
+Le_Keylength='$_keylength'
+Le_OrderFinalize='$_server/finalize/$_now'
+Le_LinkOrder='$_server/order/$_now'
+Le_LinkCert='$_server/cert/$_now'
+Le_CertCreateTime='$_now'
+Le_CertCreateTimeStr='$(date -u -d "@$_now" +%Y-%m-%dT%H:%M:%SZ)'
+Le_NextRenewTimeStr='$(date -u -d "@$_next" +%Y-%m-%dT%H:%M:%SZ)'
+Le_NextRenewTime='$_next'
+EOF
+
+  _log "Downloading cert."
+  _log "Cert success."
+  _log "Your cert is in: $_dir/$_main.cer"
+  return 0
+}
+
+case "$_action" in
+version)
+  echo "https://github.com/acmesh-official/acme.sh"
+  echo "v3.1.0"
+  ;;
+issue | signcsr)
+  if [ -n "$_csr" ]; then
+    _main="$(openssl req -in "$_csr" -noout -subject | sed 's/.*CN *= *//')"
+    # shellcheck disable=SC2046
+    set -- $(openssl req -in "$_csr" -noout -ext subjectAltName 2>/dev/null |
+      sed -n 's/DNS://gp' | tr ',' ' ')
+    [ $# -gt 0 ] || set -- "$_main"
+    case "$(openssl req -in "$_csr" -noout -text)" in
+    *id-ecPublicKey*) _keylength="ec-256" ;;
+    *) _keylength="$(openssl req -in "$_csr" -noout -text |
+      sed -n 's/.*Public-Key: (\([0-9]*\) bit).*/\1/p')" ;;
+    esac
+  fi
+  _issue "$@"
+  exit $?
+  ;;
+renew)
+  _conf="$(_issued_dir)/$_main.conf"
+  if [ ! -f "$_conf" ]; then
+    _log "'$_main' is not an issued domain, skip."
+    exit 1
+  fi
+  _keylength="$(_conf_value "$_conf" Le_Keylength)"
+  _server="$(_conf_value "$_conf" Le_API)"
+  _alt="$(_conf_value "$_conf" Le_Alt)"
+  [ "$_alt" != "no" ] && set -- "$_main" $(echo "$_alt" | tr ',' ' ')
+  _issue "$@"
+  exit $?
+  ;;
+renew-all | cron)
+  for _conf in "$_cert_home"/*/*.conf; do
+    [ -f "$_conf" ] || continue
+    _main="$(_conf_value "$_conf" Le_Domain)"
+    _log "Renew: '$_main'"
+    case "$_conf" in
+    *_ecc/*) _ecc="1" ;;
+    *) _ecc="" ;;
+    esac
+    "$0" --renew -d "$_main" --cert-home "$_cert_home" ${_force:+--force} ${_ecc:+--ecc}
+  done
+  ;;
+info)
+  _conf="$(_issued_dir)/$_main.conf"
+  echo "DOMAIN_CONF=$_conf"
+  sed "s/='\(.*\)'$/=\1/" "$_conf"
+  ;;
+list)
+  echo "Main_Domain|KeyLength|SAN_Domains|CA|Created|Renew"
+  for _conf in "$_cert_home"/*/*.conf; do
+    [ -f "$_conf" ] || continue
+    echo "$(_conf_value "$_conf" Le_Domain)|\"$(_conf_value "$_conf" Le_Keylength)\"|$(_conf_value "$_conf" Le_Alt)|$(_conf_value "$_conf" Le_API)|$(_conf_value "$_conf" Le_CertCreateTimeStr)|$(_conf_value "$_conf" Le_NextRenewTimeStr)"
+  done
+  ;;
+register-account)
+  _log "Already registered"
+  echo "ACCOUNT_THUMBPRINT='fake-thumbprint'"
+  ;;
+revoke)
+  _log "Revoke success."
+  ;;
+esac
+
+exit 0
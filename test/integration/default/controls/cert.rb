@@ -10,6 +10,12 @@ control "Cert x509 #{os.name}" do
     },
     'alpn.gn98.de' => {
       'keylength' => 4096
+    },
+    'python.gn98.de' => {
+      'keylength' => 2048
+    },
+    'keypool.gn98.de' => {
+      'keylength' => 2048
     }
   }
   crts.each do |cn, conf|
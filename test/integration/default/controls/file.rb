@@ -3,7 +3,7 @@
 control "Cert files #{os.name} #{os.release}" do
   title 'Test cert files'
 
-  crts = ['standalone.gn98.de', 'alpn.gn98.de']
+  crts = ['standalone.gn98.de', 'alpn.gn98.de', 'python.gn98.de', 'keypool.gn98.de']
 
   crts.each do |crt|
     dir = "/home/vagrant/crt/#{crt}"
@@ -20,4 +20,22 @@ control "Cert files #{os.name} #{os.release}" do
       it { should exist }
     end
   end
+
+  # the key of a --signcsr certificate is installed after the issue
+  keypool = '/home/vagrant/crt/keypool.gn98.de/keypool.gn98.de'
+  describe command("openssl x509 -noout -pubkey -in #{keypool}.cer") do
+    its('stdout') do
+      should eq command("openssl pkey -pubout -in #{keypool}.key").stdout
+    end
+  end
+
+  describe file('/home/vagrant/python.gn98.de.crt') do
+    it { should exist }
+    its('owner') { should eq 'vagrant' }
+  end
+
+  describe file('/home/vagrant/python.gn98.de.key') do
+    it { should exist }
+    its('mode') { should cmp '0600' }
+  end
 end